@@ -0,0 +1,81 @@
+"""Compare the sizes and parse times of LTLA-level files in the 'dict' and 'arrays' map data formats.
+
+A sample of the files in generated/{n}var-by-ltla_percent (which should be in the 'dict'
+format) is converted to the 'arrays' format, and the total size, gzipped size and time taken
+to parse each format are shown.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import time
+
+import key_pop_api_downloader as pgp
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sample', type=int, default=1000, help='the number of files to compare (default: 1000)')
+    parser.add_argument('--repeats', type=int, default=5, help='the number of times to parse each file (default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed for sampling files')
+    return parser.parse_args()
+
+
+def ltla_files():
+    max_var_selections = pgp.get_config('input-txt-files/config.json', 'max_var_selections')
+    for num_vars in range(1, max_var_selections + 1):
+        directory = 'generated/{}var-by-ltla_percent'.format(num_vars)
+        if not os.path.isdir(directory):
+            continue
+        for path in pgp.walk_files(directory):
+            if path.endswith('_by_geog.json'):
+                yield path
+
+
+def parse_seconds(json_bytes, repeats):
+    """Return the shortest time taken to parse `json_bytes`, out of `repeats` attempts."""
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        json.loads(json_bytes)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    args = parse_args()
+    generate_files_by_ltla = pgp.load_script('generate-files-by-ltla.py')
+
+    paths = sorted(ltla_files())
+    random.Random(args.seed).shuffle(paths)
+    totals = {
+        map_data_format: {"bytes": 0, "gzipped_bytes": 0, "seconds": 0.0}
+        for map_data_format in generate_files_by_ltla.MAP_DATA_FORMATS
+    }
+    for path in paths[:args.sample]:
+        with open(path, 'rb') as f:
+            dict_bytes = f.read()
+        data = json.loads(dict_bytes)
+        if any('count' in dataset for dataset in data.values()):
+            raise Exception('{} is already in the arrays format'.format(path))
+        arrays_bytes = json.dumps(
+            {category_id: generate_files_by_ltla.dataset_to_arrays(dataset) for category_id, dataset in data.items()}
+        ).encode('utf-8')
+        for map_data_format, json_bytes in [('dict', dict_bytes), ('arrays', arrays_bytes)]:
+            totals[map_data_format]["bytes"] += len(json_bytes)
+            totals[map_data_format]["gzipped_bytes"] += len(gzip.compress(json_bytes))
+            totals[map_data_format]["seconds"] += parse_seconds(json_bytes, args.repeats)
+
+    print('Compared {} files'.format(min(args.sample, len(paths))))
+    print('{:8} {:>14} {:>14} {:>12}'.format('format', 'bytes', 'gzipped bytes', 'parse (ms)'))
+    for map_data_format, format_totals in totals.items():
+        print('{:8} {:>14} {:>14} {:>12.1f}'.format(
+            map_data_format, format_totals["bytes"], format_totals["gzipped_bytes"], 1000 * format_totals["seconds"]
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""Compare dense and sparse lookups (and dense and COO compact files) on the sparsest downloaded cubes.
+
+For each cube, the memory used by the lookup (measured with tracemalloc), the time taken to
+build it, the time taken to look up every cell and the size of the compact file are shown.
+"""
+
+import argparse
+import random
+import time
+import tracemalloc
+
+import key_pop_api_downloader as pgp
+from key_pop_api_downloader import cube_format
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sample', type=int, default=1000,
+                        help='the number of downloaded files to check for sparsity (default: 1000)')
+    parser.add_argument('--top', type=int, default=5, help='the number of sparsest cubes to benchmark (default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='the random seed for sampling files')
+    return parser.parse_args()
+
+
+def downloaded_files():
+    for path in pgp.walk_files('downloaded'):
+        if path.endswith(cube_format.COMPACT_SUFFIX):
+            path = path[:-len(cube_format.COMPACT_SUFFIX)] + '.json.gz'
+        if path.endswith('.json.gz') and '/classifications-' not in path:
+            yield path
+
+
+def zero_fraction(path):
+    """Return the fraction of observations in a downloaded file that are zero, or None if there are none."""
+    observations = 0
+    zeros = 0
+    for obs in pgp.iter_observations(path):
+        observations += 1
+        zeros += obs['observation'] == 0
+    return None if observations == 0 else zeros / observations
+
+
+def measure(build, data):
+    """Return the lookup built by `build(data)`, the memory that it uses and the time taken."""
+    tracemalloc.start()
+    start = time.perf_counter()
+    lookup = build(data)
+    seconds = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return lookup, size, seconds
+
+
+def time_lookups(keys, get):
+    start = time.perf_counter()
+    total = 0
+    for key in keys:
+        total += get(key)
+    return total, time.perf_counter() - start
+
+
+def benchmark(path, generate_files, generate_files_by_ltla):
+    data = pgp.read_json_gz(path)
+    by_ltla = '-by-ltla/' in path
+    if by_ltla:
+        dense, dense_size, dense_time = measure(lambda d: generate_files_by_ltla.data_to_lookups(d)[0], data)
+        sparse, sparse_size, sparse_time = measure(
+            lambda d: generate_files_by_ltla.data_to_lookups(d, sparse=True)[0], data
+        )
+        keys = list(dense)
+        dense_total, dense_lookup_time = time_lookups(keys, lambda key: dense[key])
+        sparse_total, sparse_lookup_time = time_lookups(keys, lambda key: sparse.get(key, 0))
+    else:
+        dense, dense_size, dense_time = measure(generate_files.data_to_lookup, data)
+        sparse, sparse_size, sparse_time = measure(lambda d: generate_files.data_to_lookup(d, sparse=True), data)
+        keys = [key for key in dense if isinstance(key, frozenset)]
+        dense_total, dense_lookup_time = time_lookups(keys, lambda key: generate_files.lookup_count(dense, key))
+        sparse_total, sparse_lookup_time = time_lookups(keys, lambda key: generate_files.lookup_count(sparse, key))
+    if dense_total != sparse_total:
+        raise Exception('Dense and sparse totals differ for ' + path)
+    return {
+        "cells": len(keys),
+        "memory": (dense_size, sparse_size),
+        "build": (dense_time, sparse_time),
+        "lookup": (dense_lookup_time, sparse_lookup_time),
+        "compact": (len(cube_format.encode_response(data, 'dense')), len(cube_format.encode_response(data, 'coo')))
+    }
+
+
+def main():
+    args = parse_args()
+    generate_files = pgp.load_script('generate-files.py')
+    generate_files_by_ltla = pgp.load_script('generate-files-by-ltla.py')
+
+    paths = sorted(set(downloaded_files()))
+    random.Random(args.seed).shuffle(paths)
+    sparsity = {}
+    for path in paths[:args.sample]:
+        fraction = zero_fraction(path)
+        if fraction is not None:
+            sparsity[path] = fraction
+    sparsest = sorted(sparsity, key=lambda path: -sparsity[path])[:args.top]
+
+    print('{:60} {:>6} {:>8} {:>19} {:>17} {:>17} {:>17}'.format(
+        'file', 'zeros', 'cells', 'memory (KB)', 'build (ms)', 'lookup (ms)', 'compact (bytes)'
+    ))
+    for path in sparsest:
+        result = benchmark(path, generate_files, generate_files_by_ltla)
+        print('{:60} {:>5.0f}% {:>8} {:>9.0f} {:>9.0f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8} {:>8}'.format(
+            path[-60:], 100 * sparsity[path], result["cells"],
+            *(size / 1024 for size in result["memory"]),
+            *(1000 * t for t in result["build"]),
+            *(1000 * t for t in result["lookup"]),
+            *result["compact"]
+        ))
+    print('(each pair of columns is dense, then sparse)')
+
+
+if __name__ == "__main__":
+    main()
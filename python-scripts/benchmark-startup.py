@@ -0,0 +1,64 @@
+"""Measure the start-up time of each script (importing it and loading the classification metadata),
+with and without a metadata snapshot, and the time taken by the test suite."""
+
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from key_pop_api_downloader import metadata
+
+SCRIPTS = ['get-data.py', 'get-data-by-ltla.py', 'generate-files.py', 'generate-files-by-ltla.py']
+REPEATS = 5
+
+STARTUP_CODE = """
+import importlib.util
+import sys
+sys.path.insert(0, {scripts_dir!r})
+spec = importlib.util.spec_from_file_location('script', {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+from key_pop_api_downloader import metadata
+metadata.get_metadata()
+"""
+
+
+def time_command(args, cwd, before_each=None):
+    """Return the median wall-clock time of running `args` REPEATS times, or None if it fails."""
+    times = []
+    for _ in range(REPEATS):
+        if before_each is not None:
+            before_each()
+        start = time.perf_counter()
+        result = subprocess.run(args, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None
+    return statistics.median(times)
+
+
+def remove_snapshot():
+    if os.path.isfile(metadata.SNAPSHOT_FILENAME):
+        os.remove(metadata.SNAPSHOT_FILENAME)
+
+
+def format_time(seconds):
+    return 'failed' if seconds is None else '{:.3f}s'.format(seconds)
+
+
+def main():
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    print('{:30} {:>10} {:>10}'.format('script', 'cold', 'snapshot'))
+    for script in SCRIPTS:
+        code = STARTUP_CODE.format(scripts_dir=scripts_dir, path=os.path.join(scripts_dir, script))
+        cold = time_command([sys.executable, '-c', code], '.', before_each=remove_snapshot)
+        warm = time_command([sys.executable, '-c', code], '.')
+        print('{:30} {:>10} {:>10}'.format(script, format_time(cold), format_time(warm)))
+
+    tests = time_command([sys.executable, '-m', 'unittest', '-q', 'key_pop_api_downloader.test.tests'], scripts_dir)
+    print('{:30} {:>10}'.format('test suite', format_time(tests)))
+
+
+if __name__ == "__main__":
+    main()
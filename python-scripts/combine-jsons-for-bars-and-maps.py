@@ -1,30 +1,123 @@
 """This script combines pairs of JSON files: for a given set of input variable-values,
 the file for the bar chart and the file for the map are combined."""
 
-import glob
-import json
+import argparse
+import functools
+import itertools
+import multiprocessing
+import os
+
 import key_pop_api_downloader as pgp
-from pathlib import Path
-
-max_var_selections = pgp.get_config('input-txt-files/config.json', 'max_var_selections')
-
-for i in range(1, max_var_selections + 1):
-    combined_path = f'generated/{i}var-combined_percent/'
-
-    filenames = glob.glob(f'generated/{i}var_percent/**/*.json', recursive=True)
-    for filename in filenames:
-        short_filename = filename.replace(f'generated/{i}var_percent/', '')
-        with open(filename, 'r') as f:
-            bar_chart_data = json.load(f)
-        map_data_filename = f'generated/{i}var-by-ltla_percent/' + short_filename.replace('.json', '_by_geog.json')
-        with open(map_data_filename, 'r') as f:
-            map_data = json.load(f)
-        combined_data = {
-            'bar_chart_data': bar_chart_data,
-            'map_data': map_data
-        }
-        Path(combined_path + short_filename).parent.mkdir(parents=True, exist_ok=True)
-        with open(combined_path + short_filename, 'w') as f:
-            json.dump(combined_data, f)
+from key_pop_api_downloader import metadata
+from key_pop_api_downloader import validation
+
+
+def make_pair(num_vars, bar_chart_filename):
+    """Return the (bar chart, map, combined) filenames for a file in generated/{num_vars}var_percent."""
+    short_filename = bar_chart_filename.replace(f'generated/{num_vars}var_percent/', '', 1)
+    map_filename = f'generated/{num_vars}var-by-ltla_percent/' + short_filename.replace('.json', '_by_geog.json')
+    combined_filename = f'generated/{num_vars}var-combined_percent/' + short_filename
+    return bar_chart_filename, map_filename, combined_filename
+
+
+def find_pairs(num_vars):
+    """Yield the filenames of every pair of files with `num_vars` input variables, walking the tree lazily."""
+    for filename in pgp.walk_files(f'generated/{num_vars}var_percent'):
+        if filename.endswith('.json'):
+            yield make_pair(num_vars, filename)
+
+
+def combination_pairs(cc):
+    """Return the filenames of the pairs of files for the input classification combination `cc`."""
+    all_classifications = metadata.all_classifications()
+    category_lists = itertools.product(
+        *(all_classifications[c_]["categories"] for c_ in cc[:-1])
+    )
+    return [
+        make_pair(len(cc), pgp.generate_outfile_path(cc, category_list, 'generated/{}var_percent/{}', '.json'))
+        for category_list in category_lists
+    ]
+
+
+def combine_pairs(pairs, dedup_store=None, processes=None, force=False):
+    """Combine pairs of files using `pgp.combine_json_files`.
+
+    Parameters
+    ----------
+    pairs : iterable
+        (bar chart, map, combined) filename triples, for example from `find_pairs`
+    dedup_store : dict or None
+        A store from `pgp.new_dedup_store`, if files should be deduplicated
+    processes : int or None
+        The number of worker processes; None means one per CPU, and 1 combines the files in this process
+    force : bool
+        If False, pairs whose combined file is newer than both inputs are skipped
+
+    Returns
+    -------
+    int, int
+        The numbers of files written and skipped
+    """
+    combine_pair = functools.partial(
+        pgp.combine_json_files,
+        dedup_mode=None if dedup_store is None else dedup_store["mode"],
+        blob_directory='generated/blobs' if dedup_store is None else dedup_store["blob_directory"],
+        force=force
+    )
+    if processes == 1:
+        return collect_results(map(combine_pair, pairs), dedup_store)
+    with multiprocessing.Pool(processes) as pool:
+        return collect_results(pool.imap_unordered(combine_pair, pairs, chunksize=64), dedup_store)
+
+
+def collect_results(results, dedup_store):
+    written = 0
+    skipped = 0
+    for was_written, pair_dedup_store in results:
+        if not was_written:
+            skipped += 1
+            continue
+        written += 1
+        if pair_dedup_store is not None:
+            pgp.merge_dedup_stores(dedup_store, pair_dedup_store)
+    return written, skipped
+
+
+def remove_invalid_outputs(pairs, invalid_files):
+    """Yield `pairs`, first deleting each combined file in `invalid_files` so that it is rewritten."""
+    for pair in pairs:
+        if pair[2] in invalid_files and os.path.isfile(pair[2]):
+            os.remove(pair[2])
+        yield pair
+
+
+def combine_files(dedup_store=None, processes=None, force=False):
+    """Combine all pairs of files (see `combine_pairs`).  Combined files that failed validation
+    (see `validation`) are rewritten even if they are up to date."""
+    max_var_selections = pgp.get_config('input-txt-files/config.json', 'max_var_selections')
+    pairs = itertools.chain.from_iterable(find_pairs(i) for i in range(1, max_var_selections + 1))
+    pairs = remove_invalid_outputs(pairs, validation.invalid_files())
+    written, skipped = combine_pairs(pairs, dedup_store, processes, force)
+    print("Combined {} pairs of files; skipped {} that were up to date".format(written, skipped))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--dedup', choices=['hardlink', 'manifest'], help='deduplicate the combined files')
+    parser.add_argument('--processes', type=int, help='the number of worker processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true', help='rewrite combined files that are up to date')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    dedup_store = None if args.dedup is None else pgp.new_dedup_store(args.dedup)
+    combine_files(dedup_store, args.processes, args.force)
+
+    if dedup_store is not None:
+        removed_blob_count = pgp.save_dedup_manifest(dedup_store)
+        pgp.print_dedup_report(dedup_store, removed_blob_count)
 
 
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,9 @@
 
 import json
 
+import key_pop_api_downloader as pgp
+from key_pop_api_downloader import metadata as classification_metadata
+
 def get_list_from_txt_file(input_filename):
     with open(input_filename, 'r') as f:
         return [line.strip() for line in f]
@@ -22,5 +25,10 @@ if __name__ == "__main__":
         "outputClassificationsWithDetails": output_classifications_with_details
     }
 
+    # With the 'arrays' map data format, the LTLA-level files give counts and percentages in this order
+    if pgp.get_config('input-txt-files/config.json', 'map_data_format', 'dict') == 'arrays':
+        metadata["mapDataFormat"] = "arrays"
+        metadata["ltlas"] = classification_metadata.ltlas()
+
     with open('generated/metadata.json', 'w') as f:
         json.dump(metadata, f, indent=4)
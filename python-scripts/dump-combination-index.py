@@ -0,0 +1,16 @@
+"""Save the combination index (see `build_combination_index`) as JSON for inspection."""
+
+import json
+import sys
+
+from key_pop_api_downloader import metadata
+
+
+def main():
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'combination-index.json'
+    with open(filename, 'w') as f:
+        json.dump(metadata.combination_index(), f, indent=4)
+
+
+if __name__ == "__main__":
+    main()
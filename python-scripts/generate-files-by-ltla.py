@@ -1,14 +1,22 @@
 """Generate LTLA-level files from the files already downloaded from the API."""
 
+import array
+import functools
 import itertools
 import json
+import resource
+import sys
+import time
 
 import key_pop_api_downloader as pgp
+from key_pop_api_downloader import metadata
 
-with open('downloaded/ltla-geog.json', 'r') as f:
-    ltlas = [item["id"] for item in json.load(f)["items"]]
-
-all_classifications = pgp.load_all_classifications()
+# The size of each count in the packed arrays of `data_to_array`
+ARRAY_ITEM_BYTES = array.array('q').itemsize
+MEMORY_REPORT_FILENAME = 'downloaded/generate-by-ltla-memory.json'
+# 'dict' maps each LTLA code to a [count, percentage] pair; 'arrays' gives parallel arrays of
+# counts and percentages in the order of the "ltlas" list in generated/metadata.json
+MAP_DATA_FORMATS = ['dict', 'arrays']
 
 
 def generate_one_dataset(data, ltla_sums, cc, category_list):
@@ -31,30 +39,109 @@ def generate_one_dataset(data, ltla_sums, cc, category_list):
         A map from LTLA code to a [count, percentage] pair
     """
     result = {}
-    for ltla in ltlas:
-        datum_key = frozenset(
-            [
-                (cat_id, opt['id'])
-                for cat_id, opt in zip(cc, category_list)
-            ] + [('ltla', ltla)]
-        )
+    for ltla in metadata.ltlas():
+        datum_key = make_datum_key(cc, category_list, ltla)
         if datum_key in data:
             count = data[datum_key]
             result[ltla] = [count, pgp.round_fraction(100 * count, ltla_sums[ltla], 1)]
     return result
 
 
-def process_data(data, ltla_sums, cc):
+def generate_one_dataset_from_sparse_lookup(data, ltla_sums, cc, category_list):
+    """Generate a full dataset for a given set of input selections from a sparse lookup made by `data_to_lookups`.
+
+    The parameters and return value are as for `generate_one_dataset`.  Cells that are missing
+    from the lookup are zero, unless the LTLA has no observations at all.
+    """
+    result = {}
+    for ltla in metadata.ltlas():
+        if ltla in ltla_sums:
+            count = data.get(make_datum_key(cc, category_list, ltla), 0)
+            result[ltla] = [count, pgp.round_fraction(100 * count, ltla_sums[ltla], 1)]
+    return result
+
+
+def make_datum_key(cc, category_list, ltla):
+    """Return the key for looking up the count for an LTLA and a set of input categories."""
+    return frozenset(
+        [
+            (cat_id, opt['id'])
+            for cat_id, opt in zip(cc, category_list)
+        ] + [('ltla', ltla)]
+    )
+
+
+def category_list_index(cc, category_ids):
+    """Return the position of a set of categories of the classifications `cc` in
+    `itertools.product` of their category lists, given a map `category_ids` from classification to category ID."""
+    all_classifications = metadata.all_classifications()
+    index = 0
+    for c in cc:
+        index = index * len(all_classifications[c]["categories"]) + metadata.category_index(c, category_ids[c])
+    return index
+
+
+def generate_one_dataset_from_array(data, ltla_sums, cc, category_list, list_start=0):
+    """Generate a full dataset for a given set of input selections from an array returned by `data_to_array`.
+
+    The parameters and return value are as for `generate_one_dataset`, except that `data` is the array
+    and `list_start` is the `list_start` that was passed to `data_to_array`.
+    """
+    last_category_count = len(metadata.all_classifications()[cc[-1]]["categories"])
+    list_count = len(data) // (len(metadata.ltlas()) * last_category_count)
+    list_offset = category_list_index(cc[:-1], {c: opt['id'] for c, opt in zip(cc, category_list)}) - list_start
+    last_offset = metadata.category_index(cc[-1], category_list[-1]['id'])
+    result = {}
+    for ltla_index, ltla in enumerate(metadata.ltlas()):
+        count = data[(ltla_index * list_count + list_offset) * last_category_count + last_offset]
+        if count != -1:
+            result[ltla] = [count, pgp.round_fraction(100 * count, ltla_sums[ltla], 1)]
+    return result
+
+
+def dataset_to_arrays(dataset):
+    """Convert a dataset from `generate_one_dataset` to parallel arrays.
+
+    Returns
+    -------
+    dict
+        "count" and "percent" lists with an element for each LTLA in `metadata.ltlas()`,
+        which is None if the LTLA is missing from `dataset` (so both lists are all None
+        if the cube is blocked)
+    """
+    counts = []
+    percents = []
+    for ltla in metadata.ltlas():
+        count_and_percent = dataset.get(ltla)
+        if count_and_percent is None:
+            counts.append(None)
+            percents.append(None)
+        else:
+            counts.append(count_and_percent[0])
+            percents.append(count_and_percent[1])
+    return {"count": counts, "percent": percents}
+
+
+def process_data(data, ltla_sums, cc, dedup_store=None, generate_dataset=generate_one_dataset, map_data_format='dict',
+                 category_lists=None):
     """Create all of the files for a give input classification combination.
 
     Parameters
     ----------
-    data : list
-        All datasets with the input classification combination `cc`
+    data : list or array
+        All datasets with the input classification combination `cc`, as a lookup or an array
     ltla_sums : dict
         The lookup of total LTLA populations
     cc : list
         The input classification combination
+    dedup_store : dict or None
+        A store from `pgp.new_dedup_store`, if files should be deduplicated
+    generate_dataset : function
+        `generate_one_dataset` if `data` is a lookup, or `generate_one_dataset_from_array` if it is an array
+    map_data_format : str
+        One of `MAP_DATA_FORMATS`
+    category_lists : list or None
+        The category lists (see below) to create files for, if `data` only has some of them
     """
     # category_lists is a list of tuples like (1, 4), which means that the first
     # input variable has category 1 and the second input variable
@@ -62,26 +149,32 @@ def process_data(data, ltla_sums, cc):
     #
     # For the final variable in cc, we will generate a dataset for
     # each value and combine these all in a single file.
-    category_lists = itertools.product(
-        *(all_classifications[c_]["categories"] for c_ in cc[:-1])
-    )
+    all_classifications = metadata.all_classifications()
+    if category_lists is None:
+        category_lists = itertools.product(
+            *(all_classifications[c_]["categories"] for c_ in cc[:-1])
+        )
     for category_list in category_lists:
         result = {}
         for last_var_category in all_classifications[cc[-1]]["categories"]:
-            dataset = generate_one_dataset(data, ltla_sums, cc, (*category_list, last_var_category))
+            dataset = generate_dataset(data, ltla_sums, cc, (*category_list, last_var_category))
+            if map_data_format == 'arrays':
+                dataset = dataset_to_arrays(dataset)
             result[last_var_category['id']] = dataset
         filename = pgp.generate_outfile_path(cc, category_list, 'generated/{}var-by-ltla_percent/{}', '_by_geog.json')
-        with open(filename, 'w') as f:
-            json.dump(result, f)
+        pgp.write_json_file(filename, result, dedup_store)
 
 
-def data_to_lookups(data):
+def data_to_lookups(data, sparse=False):
     """Produce two lookups from an object that was returned as JSON from the Census API.
 
     Parameters
     ----------
     data : dict
         A dictionary created from a JSON response from the Census API.
+    sparse : bool
+        If True, cells whose count is zero are left out of the lookup of counts
+        (see `generate_one_dataset_from_sparse_lookup`).
 
     Returns
     -------
@@ -104,35 +197,265 @@ def data_to_lookups(data):
                 if ltla not in ltla_sums:
                     ltla_sums[ltla] = 0
                 ltla_sums[ltla] += obs['observation']
-        lookup[frozenset(dimensions)] = obs['observation']
+        if obs['observation'] != 0 or not sparse:
+            lookup[frozenset(dimensions)] = obs['observation']
 
     return lookup, ltla_sums
 
 
-def generate_files(num_vars):
+def data_to_array(observations, cc, list_start=0, list_stop=None):
+    """Produce a packed array of the counts for some of the output files of a combination,
+    and a lookup of LTLA totals, from the observations in a response from the Census API.
+
+    Unlike `data_to_lookups`, this does not need the whole response to be in memory, and
+    by passing over the observations once for each range of files, the array can be kept
+    as small as the counts for a single file.
+
+    Parameters
+    ----------
+    observations : iterable
+        The observations, for example from `pgp.iter_observations`
+    cc : list
+        The input classification combination
+    list_start, list_stop : int
+        The range of positions of the categories of `cc[:-1]` (in the order of `itertools.product`,
+        see `process_data`) whose cells are kept, with None for `list_stop` meaning all of them
+
+    Returns
+    -------
+    array.array, dict
+        The first value is an array with an element for each kept cell of the cube, in row-major
+        order with the LTLAs (in the order of `metadata.ltlas()`) as the first dimension, the position
+        of the categories of `cc[:-1]` (from `list_start`) as the second and the last classification
+        of `cc` as the third.  Cells that are missing are -1.
+        The second value is a lookup from LTLA code to the total count for that LTLA.
+    """
+    ltla_indices = {ltla: i for i, ltla in enumerate(metadata.ltlas())}
+    last_category_count = len(metadata.all_classifications()[cc[-1]]["categories"])
+    if list_stop is None:
+        list_stop = cell_count(cc) // (len(ltla_indices) * last_category_count)
+    list_count = list_stop - list_start
+    counts = array.array('q', [-1]) * (len(ltla_indices) * list_count * last_category_count)
+    ltla_sums = {}
+    for obs in observations:
+        ltla = None
+        categories = {}
+        for dim in obs['dimensions']:
+            if dim['dimension_id'] == 'ltla':
+                ltla = dim['option_id']
+                ltla_sums[ltla] = ltla_sums.get(ltla, 0) + obs['observation']
+            else:
+                categories[dim['dimension_id']] = dim['option_id']
+        list_index = category_list_index(cc[:-1], categories)
+        if ltla not in ltla_indices or not list_start <= list_index < list_stop:
+            continue
+        index = (ltla_indices[ltla] * list_count + list_index - list_start) * last_category_count
+        counts[index + metadata.category_index(cc[-1], categories[cc[-1]])] = obs['observation']
+    return counts, ltla_sums
+
+
+def cell_count(cc):
+    """Return the number of cells in the LTLA-level cube for the input classification combination `cc`."""
+    all_classifications = metadata.all_classifications()
+    result = len(metadata.ltlas())
+    for c in cc:
+        result *= len(all_classifications[c]["categories"])
+    return result
+
+
+@functools.lru_cache()
+def bytes_per_cell(num_dimensions):
+    """Return the approximate memory used for each cell of a response with `num_dimensions`
+    dimensions (including the geography) by the parsed JSON and the lookup from `data_to_lookups`.
+
+    This is the `sys.getsizeof` of a typical parsed observation and its lookup key, plus the
+    share of a large dict (the lookup) and list (the observations) that each cell takes.
+    The JSON parser shares the keys of the parsed objects, so they aren't counted.
+    For the cubes that the API returns it is within about 25% of the figure that tracemalloc
+    gives, and larger, so the ceiling is kept to.
+    """
+    obs = json.loads(json.dumps({"dimensions": [
+        {"dimension": "Classification label", "dimension_id": "classification_{}".format(i),
+         "option": "A typical category or area label", "option_id": "E06000001"}
+        for i in range(num_dimensions)
+    ], "observation": 1000}))
+    result = sys.getsizeof(obs) + sys.getsizeof(obs["dimensions"]) + sys.getsizeof(obs["observation"])
+    for dim in obs["dimensions"]:
+        result += sys.getsizeof(dim) + sum(sys.getsizeof(value) for value in dim.values())
+    key = frozenset((dim["dimension_id"], dim["option_id"]) for dim in obs["dimensions"])
+    result += sys.getsizeof(key) + sum(sys.getsizeof(pair) for pair in key)
+    entry_count = 1 << 16
+    result += sys.getsizeof(dict.fromkeys(range(entry_count))) // entry_count
+    result += sys.getsizeof([None]) - sys.getsizeof([])
+    return result
+
+
+def estimate_lookup_bytes(cc):
+    """Return the approximate memory needed by `data_to_lookups` for the combination `cc`."""
+    return cell_count(cc) * bytes_per_cell(len(cc) + 1)
+
+
+def peak_rss_bytes():
+    """Return the peak resident set size of this process so far (not just of the current combination)."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def current_rss_bytes():
+    """Return the current resident set size of this process, or None if /proc/self/statm can't be read."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * resource.getpagesize()
+
+
+def generate_combination_files(num_vars, i, combination, dedup_store=None, read_download=pgp.read_json_gz,
+                               memory_ceiling_mb=None, memory_report=None, sparse=False, map_data_format='dict'):
+    """Generate all files for one input classification combination.
+
+    If the lookup for the combination would need more than `memory_ceiling_mb` megabytes,
+    the downloaded file is read one observation at a time into packed arrays instead
+    (see `data_to_array`), without using `read_download`. It is read once for each range of
+    output files whose counts fit in `memory_ceiling_mb`, with at least one file per pass.
+
+    Parameters
+    ----------
+    num_vars : int
+        The number of input variables
+    i : int
+        The index of `combination` in the list of combinations (for progress messages)
+    combination : dict
+        An entry from the combination index (see `pgp.build_combination_index`)
+    dedup_store : dict or None
+        A store from `pgp.new_dedup_store`, if files should be deduplicated
+    read_download : function
+        The function used to read a downloaded file, given its path
+    memory_ceiling_mb : int or None
+        The most memory that the lookup may use, or None for no limit
+    memory_report : list or None
+        If not None, a dictionary of memory statistics for the combination is appended to this list.
+        'rss_delta_mb' is the change in resident set size from the start of the combination to
+        when its files have been written, while its lookup or array is still held
+    sparse : bool
+        Whether to use a sparse lookup (see `data_to_lookups`), if the packed array is not used
+    map_data_format : str
+        One of `MAP_DATA_FORMATS`
+    """
+    cc = combination["cc"]
+    print("{} var: Processing {} of {} ({})".format(
+            num_vars, i+1, len(metadata.combinations(num_vars)), "-".join(cc))
+        )
+    start = time.perf_counter()
+    start_rss = current_rss_bytes() if memory_report is not None else None
+    estimated_bytes = estimate_lookup_bytes(cc)
+    chunked = memory_ceiling_mb is not None and estimated_bytes > memory_ceiling_mb * 1024 * 1024
+    passes = 1
+    if chunked:
+        all_classifications = metadata.all_classifications()
+        category_lists = list(itertools.product(*(all_classifications[c]["categories"] for c in cc[:-1])))
+        list_bytes = len(metadata.ltlas()) * len(all_classifications[cc[-1]]["categories"]) * ARRAY_ITEM_BYTES
+        lists_per_pass = max(1, memory_ceiling_mb * 1024 * 1024 // list_bytes)
+        passes = -(-len(category_lists) // lists_per_pass)
+        print("Estimated lookup size {:.0f} MB exceeds the ceiling of {} MB; using packed arrays in {} passes".format(
+            estimated_bytes / 1024 / 1024, memory_ceiling_mb, passes
+        ))
+        entries = 0
+        data_bytes = 0
+        for list_start in range(0, len(category_lists), lists_per_pass):
+            list_stop = min(list_start + lists_per_pass, len(category_lists))
+            data, ltla_sums = data_to_array(pgp.iter_observations(combination["ltla_path"]), cc, list_start, list_stop)
+            generate_dataset = functools.partial(generate_one_dataset_from_array, list_start=list_start)
+            process_data(data, ltla_sums, cc, dedup_store, generate_dataset, map_data_format,
+                         category_lists[list_start:list_stop])
+            if memory_report is not None:
+                entries += sum(count != -1 for count in data)
+                data_bytes = max(data_bytes, data.buffer_info()[1] * data.itemsize)
+    else:
+        data, ltla_sums = data_to_lookups(read_download(combination["ltla_path"]), sparse)
+        entries = len(data)
+        # Measuring the lookup itself would take another pass over it, so only the estimate is reported
+        data_bytes = None
+        generate_dataset = generate_one_dataset_from_sparse_lookup if sparse else generate_one_dataset
+        process_data(data, ltla_sums, cc, dedup_store, generate_dataset, map_data_format)
+    if memory_report is not None:
+        end_rss = current_rss_bytes()
+        memory_report.append({
+            "cc": cc,
+            "mode": "chunked" if chunked else "sparse" if sparse else "lookup",
+            "cells": cell_count(cc),
+            "passes": passes,
+            "entries": entries,
+            "estimated_lookup_bytes": estimated_bytes,
+            "data_bytes": data_bytes,
+            "rss_delta_mb": None if start_rss is None else round((end_rss - start_rss) / 1024 / 1024, 1),
+            "cumulative_peak_rss_mb": round(peak_rss_bytes() / 1024 / 1024, 1),
+            "seconds": round(time.perf_counter() - start, 3)
+        })
+
+
+def generate_files(num_vars, dedup_store=None, memory_ceiling_mb=None, memory_report=None, sparse=False,
+                   map_data_format='dict'):
     """Generate all files with `num_vars` input variables.
 
     Parameters
     ----------
     num_vars : int
         The number of input variables
+    dedup_store : dict or None
+        A store from `pgp.new_dedup_store`, if files should be deduplicated
+    memory_ceiling_mb : int or None
+        See `generate_combination_files`
+    memory_report : list or None
+        See `generate_combination_files`
+    sparse : bool
+        See `generate_combination_files`
+    map_data_format : str
+        See `generate_combination_files`
     """
-    input_classifications, _ = pgp.load_input_and_output_classification_codes()
-    input_classification_combinations = pgp.get_input_classification_combinations(input_classifications, num_vars)
-    for i, cc in enumerate(input_classification_combinations):
-        c_str = "-".join(cc)
-        print("{} var: Processing {} of {} ({})".format(
-                num_vars, i+1, len(input_classification_combinations), c_str)
-            )
-        compressed_file_path = 'downloaded/{}var-by-ltla/{}_by_geog.json.gz'.format(num_vars, c_str)
-        data, ltla_sums = data_to_lookups(pgp.read_json_gz(compressed_file_path))
-        process_data(data, ltla_sums, cc)
+    for i, combination in enumerate(metadata.combinations(num_vars)):
+        generate_combination_files(
+            num_vars, i, combination, dedup_store, memory_ceiling_mb=memory_ceiling_mb, memory_report=memory_report,
+            sparse=sparse, map_data_format=map_data_format
+        )
+
+
+def save_memory_report(memory_report, filename=MEMORY_REPORT_FILENAME):
+    """Save the memory statistics from `generate_combination_files`, and print the largest."""
+    with open(filename, 'w') as f:
+        json.dump(memory_report, f, indent=4)
+    if len(memory_report) > 0:
+        largest = max(memory_report, key=lambda entry: entry["estimated_lookup_bytes"])
+        print("Largest combination: {} ({} cells, {} mode, RSS change {} MB); peak RSS of the process {} MB".format(
+            "-".join(largest["cc"]), largest["cells"], largest["mode"], largest["rss_delta_mb"],
+            max(entry["cumulative_peak_rss_mb"] for entry in memory_report)
+        ))
+
+
+def get_map_data_format():
+    """Return the format of the map data from `map_data_format` in config.json (default 'dict')."""
+    map_data_format = pgp.get_config("input-txt-files/config.json", "map_data_format", 'dict')
+    if map_data_format not in MAP_DATA_FORMATS:
+        raise ValueError("map_data_format should be one of " + ", ".join(MAP_DATA_FORMATS))
+    return map_data_format
 
 
 def main():
+    dedup_store = pgp.dedup_store_from_args(sys.argv)
     max_var_selections = pgp.get_config("input-txt-files/config.json", "max_var_selections")
+    memory_ceiling_mb = pgp.get_config("input-txt-files/config.json", "ltla_memory_ceiling_mb", 2048)
+    memory_report = []
+    sparse = '--sparse' in sys.argv
+    map_data_format = get_map_data_format()
     for num_vars in range(1, max_var_selections + 1):
-        generate_files(num_vars)
+        generate_files(num_vars, dedup_store, memory_ceiling_mb, memory_report, sparse, map_data_format)
+    save_memory_report(memory_report)
+
+    if dedup_store is not None:
+        removed_blob_count = pgp.save_dedup_manifest(dedup_store)
+        pgp.print_dedup_report(dedup_store, removed_blob_count)
 
 
 if __name__ == "__main__":
@@ -3,17 +3,15 @@
 import itertools
 import json
 import os
+import sys
 
 import key_pop_api_downloader as pgp
-
-all_classifications = pgp.load_all_classifications()
-input_classifications, output_classifications = pgp.load_input_and_output_classification_codes()
-output_classification_details_dict = pgp.load_output_classification_details(all_classifications)
+from key_pop_api_downloader import metadata
 
 
 def is_resident_age(c):
     """Return true if and only if c is a resident_age classification."""
-    return pgp.remove_classification_number(c) == "resident_age"
+    return metadata.classification_family(c) == "resident_age"
 
 
 def make_datum_key(cc, category_list, c, cell_id):
@@ -67,15 +65,15 @@ def make_datum_key_for_pop_totals(cc, category_list):
 
 def input_age_range(cc, category_list):
     for i, classification in enumerate(cc):
-        if pgp.remove_classification_number(classification) == "resident_age":
+        if is_resident_age(classification):
             return pgp.age_band_text_to_numbers(category_list[i]["label"])
     return [0, 999]
 
 
 def nests_nicely(c, input_age_range):
-    if pgp.remove_classification_number(c) != "resident_age":
+    if not is_resident_age(c):
         return True
-    for category in all_classifications[c]['categories']:
+    for category in metadata.all_classifications()[c]['categories']:
         age_band = pgp.age_band_text_to_numbers(category['label'])
         if age_band[0] < input_age_range[0] and age_band[1] >= input_age_range[0]:
             return False
@@ -106,14 +104,15 @@ def sum_of_cell_values(dataset, cc, category_list, c, cell_ids):
         The total of the counts.
     """
     input_ages = input_age_range(cc, category_list)
+    categories_map = metadata.all_classifications()[c]['categories_map']
     total = 0
     for cell_id in cell_ids:
-        if pgp.remove_classification_number(c) == "resident_age":
-            output_ages = pgp.age_band_text_to_numbers(all_classifications[c]['categories_map'][str(cell_id)])
+        if is_resident_age(c):
+            output_ages = pgp.age_band_text_to_numbers(categories_map[str(cell_id)])
             if output_ages[0] < input_ages[0] or output_ages[1] > input_ages[1]:
                 continue
         datum_key = make_datum_key(cc, category_list, c, cell_id)
-        total += dataset['data'][datum_key]
+        total += lookup_count(dataset['data'], datum_key)
     return total
 
 
@@ -171,7 +170,7 @@ def generate_one_dataset(data, total_pops_data, cc, category_list):
         if not nests_nicely(c, input_ages):
             result[c] = "unavailable_age_range"
             continue
-        output_categories = output_classification_details_dict[c]['categories']
+        output_categories = metadata.output_classification_details()[c]['categories']
         result[c] = {"count": [], "percent": []}
         cat_totals = [
             sum_of_cell_values(dataset, cc, category_list, c, cat['cells'])
@@ -189,7 +188,7 @@ def generate_one_dataset(data, total_pops_data, cc, category_list):
         if total_pops_data['blocked']:
             result["total_pop"] = {'count': None, 'percent': None}
         else:
-            total_pop = total_pops_data[make_datum_key_for_pop_totals(cc, category_list)]
+            total_pop = lookup_count(total_pops_data, make_datum_key_for_pop_totals(cc, category_list))
             total_pop_pct = calc_percent(
                 total_pop,
                 total_pops_data['total_of_counts']
@@ -199,7 +198,7 @@ def generate_one_dataset(data, total_pops_data, cc, category_list):
     return result
 
 
-def process_data(data, total_pops_data, cc):
+def process_data(data, total_pops_data, cc, dedup_store=None):
     """Create all of the files for a give input classification combination
 
     Parameters
@@ -210,13 +209,14 @@ def process_data(data, total_pops_data, cc):
         The lookup of total populations
     cc : list
         The input classification combination
+    dedup_store : dict or None
+        A store from `pgp.new_dedup_store`, if files should be deduplicated
     """
     if len(cc) == 0:
         result = generate_one_dataset(data, None, cc, [])
         os.makedirs('generated/0var_percent', exist_ok=True)
         out_filename = 'generated/0var_percent/data.json'
-        with open(out_filename, 'w') as f:
-            json.dump(result, f)
+        pgp.write_json_file(out_filename, result, dedup_store)
     else:
         # category_lists is a list of tuples like (1, 4), which means that the first
         # input variable has category 1 and the second input variable
@@ -224,6 +224,7 @@ def process_data(data, total_pops_data, cc):
         #
         # For the final variable in cc, we will generate a dataset for
         # each value and combine these all in a single file.
+        all_classifications = metadata.all_classifications()
         category_lists = itertools.product(
             *(all_classifications[c_]["categories"] for c_ in cc[:-1])
         )
@@ -233,17 +234,18 @@ def process_data(data, total_pops_data, cc):
                 dataset = generate_one_dataset(data, total_pops_data, cc, (*category_list, last_var_category))
                 result[last_var_category['id']] = dataset
             out_filename = pgp.generate_outfile_path(cc, category_list, 'generated/{}var_percent/{}', '.json')
-            with open(out_filename, 'w') as f:
-                json.dump(result, f)
+            pgp.write_json_file(out_filename, result, dedup_store)
 
 
-def data_to_lookup(data):
+def data_to_lookup(data, sparse=False):
     """Produce a lookup from an object that was returned as JSON from the Census API.
 
     Parameters
     ----------
     data : dict
         A dictionary created from a JSON response from the Census API.
+    sparse : bool
+        If True, cells whose count is zero are left out of the lookup (see `lookup_count`).
 
     Returns
     -------
@@ -254,8 +256,10 @@ def data_to_lookup(data):
     if data["blocked_areas"] != 0:
         return {'blocked': True}
 
-    lookup = {'blocked': False, 'total_of_counts': 0}
+    lookup = {'blocked': False, 'sparse': sparse, 'total_of_counts': 0}
     for obs in data['observations']:
+        if sparse and obs['observation'] == 0:
+            continue
         dimensions = []
         for dim in obs['dimensions']:
             if dim['dimension_id'] != 'nat':   # ignore the geo dimension
@@ -266,31 +270,61 @@ def data_to_lookup(data):
     return lookup
 
 
-def make_c_str(cc, c):
-    """Generate a file name for a list of input classifications and an output classification.
-
-    Parameters
-    ----------
-    cc : list
-        The input classifications
-    c : str
-        The output classification
+def lookup_count(lookup, datum_key):
+    """Return the count for `datum_key` from a lookup made by `data_to_lookup`.
 
-    Returns
-    -------
-    The number of classifications, and the filename.
+    Keys that are missing from a sparse lookup have a count of zero.
     """
-    # This is used to generate a file name for a list of input classifications and
-    # an output classification.  If the output classification is for resident age,
-    # then any resident_age input classifications are deleted.
-    if is_resident_age(c):
-        classifications = [c_ for c_ in list(cc) if not is_resident_age(c_)] + [c]
-    else:
-        classifications = list(cc) + [c]
-    return len(classifications), "-".join(classifications)
+    if lookup['sparse']:
+        return lookup.get(datum_key, 0)
+    return lookup[datum_key]
+
 
+def generate_combination_files(num_vars, i, combination, unblocked_combination_counts, dedup_store=None,
+                               read_download=pgp.read_json_gz, sparse=False):
+    """Generate all files for one input classification combination.
 
-def generate_files(num_vars, unblocked_combination_counts):
+    The number of unblocked variables will be saved to the dictionary `unblocked_combination_counts`.
+
+    Parameters
+    ----------
+    num_vars : int
+        The number of input variables
+    i : int
+        The index of `combination` in the list of combinations (for progress messages)
+    combination : dict
+        An entry from the combination index (see `pgp.build_combination_index`)
+    unblocked_combination_counts : dict
+        A dictionary to which the number of unblocked output variables for each input variable will be saved
+    dedup_store : dict or None
+        A store from `pgp.new_dedup_store`, if files should be deduplicated
+    read_download : function
+        The function used to read a downloaded file, given its path
+    sparse : bool
+        Whether to use sparse lookups (see `data_to_lookup`)
+    """
+    cc = combination["cc"]
+    num_combinations = len(metadata.combinations(num_vars))
+    data = []
+    total_pops_data = None
+    # The combination index only includes output classifications that we have downloaded
+    # data for.  Since the API won't give data for two versions of the same variable, this
+    # excludes outputs with the same family as an input, except for resident_age, which is
+    # a special case where we just use the data for 18 or 23 categories.
+    for output in combination["outputs"]:
+        print("{} var: Processing {} of {} ({})".format(num_vars, i+1, num_combinations, output["path"]))
+        data.append({
+            "c": output["c"],
+            "data": data_to_lookup(read_download(output["path"]), sparse)
+        })
+    if num_vars > 0:
+        # We can get the exact total pop for the categories selected in the web-app.
+        total_pops_data = data_to_lookup(read_download(combination["total_path"]), sparse)
+    process_data(data, total_pops_data, cc, dedup_store)
+    unblocked_combination_counts[','.join(cc)] = sum(not d['data']['blocked'] for d in data)
+
+
+def generate_files(num_vars, unblocked_combination_counts, dedup_store=None, sparse=False):
     """Generate all files with `num_vars` input variables.
 
     The number of unblocked variables will be saved to the dictionary `unblocked_combination_counts`.
@@ -301,33 +335,20 @@ def generate_files(num_vars, unblocked_combination_counts):
         The number of input variables
     unblocked_combination_counts : dict
         A dictionary to which the number of unblocked output variables for each input variable will be saved
+    dedup_store : dict or None
+        A store from `pgp.new_dedup_store`, if files should be deduplicated
+    sparse : bool
+        Whether to use sparse lookups (see `data_to_lookup`)
     """
-    icc = pgp.get_input_classification_combinations(input_classifications, num_vars)
-    for i, cc in enumerate(icc):
-        data = []
-        total_pops_data = None
-        for c in output_classifications:
-            if not is_resident_age(c) and pgp.remove_classification_number(c) in [
-                    pgp.remove_classification_number(c_) for c_ in cc
-                ]:
-                # The API won't give data for two versions of the same variable.
-                # Since we haven't downloaded it, we can't use it to generate files :-)
-                # The exception is for resident_age, which is a special case where
-                # we just use the data for 18 or 23 categories.
-                continue
-            c_str_len, c_str = make_c_str(cc, c)
-            print("{} var: Processing {} of {} ({})".format(num_vars, i+1, len(icc), c_str))
-            file_path = 'downloaded/{}var/{}.json.gz'.format(c_str_len-1, c_str)
-            data.append({
-                "c": c,
-                "data": data_to_lookup(pgp.read_json_gz(file_path))
-            })
-        if num_vars > 0:
-            # We can get the exact total pop for the categories selected in the web-app.
-            total_pops_file_path = 'downloaded/{}var/{}.json.gz'.format(num_vars, "-".join(cc))
-            total_pops_data = data_to_lookup(pgp.read_json_gz(total_pops_file_path))
-        process_data(data, total_pops_data, cc)
-        unblocked_combination_counts[','.join(cc)] = sum(not d['data']['blocked'] for d in data)
+    for i, combination in enumerate(metadata.combinations(num_vars)):
+        generate_combination_files(
+            num_vars, i, combination, unblocked_combination_counts, dedup_store, sparse=sparse
+        )
+
+
+def save_unblocked_combination_counts(unblocked_combination_counts):
+    with open('generated/unblocked-combination-counts.json', 'w') as f:
+        json.dump(unblocked_combination_counts, f)
 
 
 def main():
@@ -335,13 +356,18 @@ def main():
     # unblocked_combination_counts stores the number of output variables whose
     # data is not blocked.
     unblocked_combination_counts = {}
+    dedup_store = pgp.dedup_store_from_args(sys.argv)
+    sparse = '--sparse' in sys.argv
 
     max_var_selections = pgp.get_config("input-txt-files/config.json", "max_var_selections")
     for num_vars in range(0, max_var_selections + 1):
-        generate_files(num_vars, unblocked_combination_counts)
+        generate_files(num_vars, unblocked_combination_counts, dedup_store, sparse)
 
-    with open('generated/unblocked-combination-counts.json', 'w') as f:
-        json.dump(unblocked_combination_counts, f)
+    if dedup_store is not None:
+        removed_blob_count = pgp.save_dedup_manifest(dedup_store)
+        pgp.print_dedup_report(dedup_store, removed_blob_count)
+
+    save_unblocked_combination_counts(unblocked_combination_counts)
 
 
 if __name__ == "__main__":
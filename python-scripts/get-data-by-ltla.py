@@ -1,34 +1,77 @@
 """Download all LTLA-level data from the API and save to gzipped files."""
 
-import gzip
-import os.path
+import concurrent.futures
+import functools
 import requests
 import sys
-import time
 
 import key_pop_api_downloader as pgp
+from key_pop_api_downloader import metadata
+from key_pop_api_downloader import validation
+from key_pop_api_downloader.throttle import AdaptiveThrottle
+
+
+def get_file(num_vars, i, combination, config):
+    """Download from the API and save the LTLA-level file for an input classification combination.
+
+    Parameters
+    ----------
+    num_vars : int
+        The number of input variables
+    i : int
+        The index of `combination` in the list of combinations (for progress messages)
+    combination : dict
+        An entry from the combination index (see `pgp.build_combination_index`)
+    config : dict
+        A config object
+    """
+    c_str = ",".join(combination["cc"])
+    num_combinations = len(metadata.combinations(num_vars))
+    if pgp.is_skipped_download(combination["ltla_path"], config):
+        print("{} var: Skipping existing file {} of {} ({})".format(num_vars, i+1, num_combinations, c_str))
+        return
+    print("{} var: Downloading {} of {} ({})".format(num_vars, i+1, num_combinations, c_str))
+    url = config["url_pattern"].format(c_str)
+    response_bytes = config["throttle"].fetch(url, functools.partial(requests.get, timeout=config["request_timeout"]))
+    pgp.save_download(combination["ltla_path"], response_bytes, config["compact"], config["keep_json"])
+    if config["download_cache"] is not None:
+        config["download_cache"].put(combination["ltla_path"], response_bytes)
+
+
+def make_config(args):
+    """Return a config object for the command-line arguments `args`."""
+    return {
+        "url_pattern": pgp.get_config("input-txt-files/config.json", "ltla_url_pattern"),
+        "skip_existing_files": '--skip-existing' in args,
+        # Files that failed validation, which are downloaded again even with --skip-existing
+        "invalid_files": validation.invalid_files(),
+        "compact": '--compact' in args,
+        "keep_json": '--keep-json' in args,
+        # Seconds to wait for the connection or for more data, after which the request is retried
+        "request_timeout": pgp.get_config("input-txt-files/config.json", "request_timeout_seconds", 300),
+        "throttle": AdaptiveThrottle(
+            max_concurrency=pgp.get_config("input-txt-files/config.json", "max_concurrent_requests"),
+            metrics_filename='downloaded/download-by-ltla-metrics.json'
+        ),
+        # An object with a put(path, response_bytes) method, to which each downloaded file is also passed
+        "download_cache": None
+    }
 
 
 def main():
-    url_pattern = pgp.get_config("input-txt-files/config.json", "ltla_url_pattern")
     max_var_selections = pgp.get_config("input-txt-files/config.json", "max_var_selections")
-    skip_existing_files = '--skip-existing' in sys.argv
-    input_classifications, _ = pgp.load_input_and_output_classification_codes()
+    config = make_config(sys.argv)
+    throttle = config["throttle"]
 
     for num_vars in range(1, max_var_selections + 1):
-        input_classification_combinations = pgp.get_input_classification_combinations(input_classifications, num_vars)
-        for i, cc in enumerate(input_classification_combinations):
-            c_str = ",".join(cc)
-            compressed_file_path = 'downloaded/{}var-by-ltla/{}_by_geog.json.gz'.format(num_vars, c_str.replace(',', '-'))
-            if skip_existing_files and os.path.isfile(compressed_file_path):
-                print("{} var: Skipping existing file {} of {} ({})".format(num_vars, i+1, len(input_classification_combinations), c_str))
-                continue
-            print("{} var: Downloading {} of {} ({})".format(num_vars, i+1, len(input_classification_combinations), c_str))
-            url = url_pattern.format(c_str)
-            response_bytes = requests.get(url, stream=True).content
-            with gzip.open(compressed_file_path, 'wb') as f:
-                f.write(response_bytes)
-            time.sleep(0.5)
+        with concurrent.futures.ThreadPoolExecutor(throttle.max_concurrency) as executor:
+            futures = [
+                executor.submit(get_file, num_vars, i, combination, config)
+                for i, combination in enumerate(metadata.combinations(num_vars))
+            ]
+            for future in futures:
+                future.result()
+    throttle.report()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,34 @@
 """Download all national-level data from the API and save to gzipped files."""
 
-import gzip
-import os.path
+import concurrent.futures
+import functools
+import json
 import requests
 import sys
 import time
 
 import key_pop_api_downloader as pgp
+from key_pop_api_downloader import metadata
+from key_pop_api_downloader import validation
+from key_pop_api_downloader.throttle import AdaptiveThrottle
+
+def download(url, config):
+    """Download a file from the API, retrying after connection errors and timeouts.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the JSON file to download
+    config : dict
+        A config object
+
+    Returns
+    -------
+    bytes
+        The response
+    """
+    return config["throttle"].fetch(url, functools.partial(requests.get, timeout=config["request_timeout"]))
+
 
 def get_file(compressed_file_path, url, config):
     """Download from the API, gzip and save a single file.
@@ -20,49 +42,165 @@ def get_file(compressed_file_path, url, config):
     config : dict
         A config object
     """
-    if config["skip_existing_files"] and os.path.isfile(compressed_file_path):
+    if pgp.is_skipped_download(compressed_file_path, config):
         print("Skipping existing file {}".format(compressed_file_path))
         return
     print("Downloading {}".format(compressed_file_path))
-    for i in range(10):   # Try ten times to download
-        try:
-            response_bytes = requests.get(url, stream=True).content
-            break
-        except requests.exceptions.ConnectionError:
-            print('Connection error')
-            time.sleep((i + 1) * 10)
-    with gzip.open(compressed_file_path, 'wb') as f:
-        f.write(response_bytes)
-    time.sleep(0.5)
+    response_bytes = download(url, config)
+    pgp.save_download(compressed_file_path, response_bytes, config["compact"], config["keep_json"])
+    if config["download_cache"] is not None:
+        config["download_cache"].put(compressed_file_path, response_bytes)
 
 
-def is_household_var(classification_code, all_classifications):
-    """Return True if and only if classification_code is for a household variable.
+def get_bundle(combination, bundle, poptype, total_data, config):
+    """Download a single cube with the input classifications of `combination` and all of the output
+    classifications in `bundle`, and save a file for each output classification by summing over the others.
+
+    The API perturbs each cube independently, so the saved files are not the same as the files that
+    one request per output classification would give. If `total_data` is given, the cube's sums over
+    the output classifications are checked against it as in `validation.check_downloads`.
 
     Parameters
     ----------
-    classification_code : string
-        The variable's classification code
-    all_classifications : dict
-        A dictionary of information including population type for each classification code
+    combination : dict
+        An entry from the combination index (see `pgp.build_combination_index`)
+    bundle : list
+        The entries of `combination["outputs"]` to download
+    poptype : str
+        The population type, 'UR' or 'UR_HH'
+    total_data : dict or None
+        The response for the file of totals for the input classifications
+    config : dict
+        A config object
+
+    Returns
+    -------
+    bool
+        False if the API blocked the cube, did not return JSON, or its sums do not match `total_data`,
+        in which case nothing is saved
     """
-    expected_result = any(
-        classification_code.startswith(prefix)
-        for prefix in [
-            'hh_', 'accommodation_type', 'number_bedrooms', 'occupancy_rating_bedrooms',
-            'number_of_cars', 'heating_type'
-        ]
-    )
-    result = 'UR' not in all_classifications[classification_code]['poptypes']
-    if expected_result != result:
-        # To be extra-cautious, we test it two ways and make sure they're consistent
-        raise Exception('Unexpected is_household_var() result for ' + classification_code)
-    return result
+    cc = combination["cc"]
+    c_str = ",".join(cc + [output["c"] for output in bundle])
+    url = config["url_pattern"].format(poptype, c_str)
+    print(url)
+    try:
+        data = json.loads(download(url, config).decode('utf-8'))
+    except ValueError:
+        # Not a JSON response from the API (e.g. an error page for a cube that it won't give)
+        print("Bundle response is not JSON; falling back to one request per output classification")
+        return False
+    if not isinstance(data, dict) or data.get("blocked_areas", 0) != 0 or data.get("observations") is None:
+        print("Bundle blocked; falling back to one request per output classification")
+        return False
+    if total_data is not None:
+        difference = validation.compare_marginals(
+            validation.marginal_counts(data, cc), validation.marginal_counts(total_data, cc),
+            validation.DEFAULT_TOLERANCE
+        )
+        if difference is not None:
+            print("Bundle sums do not match {} ({}); falling back to one request per output classification".format(
+                combination["total_path"], difference
+            ))
+            return False
+    for output in bundle:
+        save_marginal(output["path"], data, ['nat'] + cc + [output["c"]], config)
+    return True
+
+
+def save_marginal(compressed_file_path, data, dimension_ids, config):
+    marginal_bytes = json.dumps(pgp.marginalise_response(data, dimension_ids)).encode('utf-8')
+    pgp.save_download(compressed_file_path, marginal_bytes, config["compact"], config["keep_json"])
+    if config["download_cache"] is not None:
+        config["download_cache"].put(compressed_file_path, marginal_bytes)
+
+
+def get_bundles(combination, outputs, total_data, config):
+    """Download the data for an input classification combination and the output classifications
+    `outputs` in as few requests as possible, using `get_bundle`.
+
+    UR bundles are only downloaded if they can be checked against `total_data`. There is no
+    file of totals for UR_HH, so UR_HH bundles are not checked.
+
+    Parameters
+    ----------
+    combination : dict
+        An entry from the combination index
+    outputs : list
+        The entries of `combination["outputs"]` to download
+    total_data : dict or None
+        The unblocked response for the file of totals for the input classifications, if there is one
+    config : dict
+        A config object
+
+    Returns
+    -------
+    list
+        The entries of `outputs` that were not saved from a bundle, which should be downloaded one at a time
+    """
+    all_classifications = metadata.all_classifications()
+    cc = combination["cc"]
+    outputs_by_code = {output["c"]: output for output in outputs}
+    category_counts = {c: len(all_classifications[c]["categories"]) for c in cc + list(outputs_by_code)}
+    families = {c: metadata.classification_family(c) for c in cc + list(outputs_by_code)}
+    remaining_outputs = []
+    for poptype in ["UR", "UR_HH"]:
+        poptype_outputs = [output["c"] for output in outputs if output["poptype"] == poptype]
+        if poptype == "UR" and total_data is None:
+            remaining_outputs += [outputs_by_code[c] for c in poptype_outputs]
+            continue
+        for bundle in pgp.bundle_output_classifications(
+            cc, poptype_outputs, category_counts, families, config["bulk_max_outputs"], config["bulk_max_cells"]
+        ):
+            bundle = [outputs_by_code[c] for c in bundle]
+            if len(bundle) == 1:
+                remaining_outputs += bundle
+                continue
+            if not get_bundle(combination, bundle, poptype, total_data if poptype == "UR" else None, config):
+                remaining_outputs += bundle
+    return remaining_outputs
+
+
+def get_combination_files(combination, config):
+    """Download from the API, gzip and save all the data files for an input classification combination.
+
+    Parameters
+    ----------
+    combination : dict
+        An entry from the combination index
+    config : dict
+        A config object
+    """
+    cc = combination["cc"]
+    # Outputs of the same family as an input are downloaded for a smaller combination,
+    # since the API won't give data for two versions of the same variable
+    outputs = [output for output in combination["outputs"] if output["download"]]
+    # The file of totals is always downloaded on its own, since it is used to check the bundles
+    if combination["total_path"] is not None:
+        url = config["url_pattern"].format("UR", ",".join(cc))
+        print(url)
+        get_file(combination["total_path"], url, config)
+    if config["bulk"]:
+        total_data = None
+        if combination["total_path"] is not None:
+            total_data = pgp.read_json_gz(combination["total_path"])
+            if validation.is_blocked(total_data):
+                total_data = None
+        outputs = get_bundles(combination, [
+            output for output in outputs
+            if not pgp.is_skipped_download(output["path"], config)
+        ], total_data, config)
+    for output in outputs:
+        url = config["url_pattern"].format(output["poptype"], ",".join(cc + [output["c"]]))
+        print(url)
+        get_file(output["path"], url, config)
 
 
 def get_files(num_vars, config):
     """Download from the API, gzip and save all the data files with `num_vars` input variables.
 
+    Input classification combinations are processed concurrently; `config["throttle"]`
+    controls how many requests are actually in flight.
+
     Parameters
     ----------
     num_vars : int
@@ -70,43 +208,47 @@ def get_files(num_vars, config):
     config : dict
         A config object
     """
-    input_classification_combinations = pgp.get_input_classification_combinations(
-        config["input_classifications"], num_vars
-    )
-    for cc in input_classification_combinations:
-        if num_vars > 0:
-            c_str = ",".join(cc)
-            url = config["url_pattern"].format("UR", c_str)
-            print(url)
-            compressed_file_path = 'downloaded/{}var/{}.json.gz'.format(num_vars, c_str.replace(',', '-'))
-            get_file(compressed_file_path, url, config)
-        for c in config["output_classifications"]:
-            if pgp.remove_classification_number(c) in [pgp.remove_classification_number(c_) for c_ in cc]:
-                # The API won't give data for two versions of the same variable
-                continue
-            c_str = ",".join(list(cc) + [c])
-            url = config["url_pattern"].format(
-                "UR_HH" if is_household_var(c, config["all_classifications"]) else "UR",
-                c_str
-            )
-            print(url)
-            compressed_file_path = 'downloaded/{}var/{}.json.gz'.format(num_vars, c_str.replace(',', '-'))
-            get_file(compressed_file_path, url, config)
+    with concurrent.futures.ThreadPoolExecutor(config["throttle"].max_concurrency) as executor:
+        futures = [
+            executor.submit(get_combination_files, combination, config)
+            for combination in metadata.combinations(num_vars)
+        ]
+        for future in futures:
+            future.result()
 
 
-def main():
-    input_classifications, output_classifications = pgp.load_input_and_output_classification_codes()
-    config = {
+def make_config(args):
+    """Return a config object for the command-line arguments `args`."""
+    return {
         "url_pattern": pgp.get_config("input-txt-files/config.json", "national_url_pattern"),
-        "skip_existing_files": '--skip-existing' in sys.argv,
-        "input_classifications": input_classifications,
-        "output_classifications": output_classifications,
-        "all_classifications": pgp.load_all_classifications()
+        "skip_existing_files": '--skip-existing' in args,
+        # Files that failed validation, which are downloaded again even with --skip-existing
+        "invalid_files": validation.invalid_files(),
+        "compact": '--compact' in args,
+        "keep_json": '--keep-json' in args,
+        # Seconds to wait for the connection or for more data, after which the request is retried
+        "request_timeout": pgp.get_config("input-txt-files/config.json", "request_timeout_seconds", 300),
+        "bulk": '--bulk' in args,
+        "bulk_max_outputs": pgp.get_config("input-txt-files/config.json", "bulk_max_outputs"),
+        "bulk_max_cells": pgp.get_config("input-txt-files/config.json", "bulk_max_cells"),
+        "throttle": AdaptiveThrottle(
+            max_concurrency=pgp.get_config("input-txt-files/config.json", "max_concurrent_requests"),
+            metrics_filename='downloaded/download-metrics.json'
+        ),
+        # An object with a put(path, response_bytes) method, to which each downloaded file is also passed
+        "download_cache": None
     }
+
+
+def main():
+    config = make_config(sys.argv)
     max_var_selections = pgp.get_config("input-txt-files/config.json", "max_var_selections")
 
+    start_time = time.time()
     for num_vars in range(0, max_var_selections + 1):
         get_files(num_vars, config)
+    config["throttle"].report()
+    print("{} requests in {:.1f} seconds".format(config["throttle"].request_count, time.time() - start_time))
 
 
 if __name__ == "__main__":
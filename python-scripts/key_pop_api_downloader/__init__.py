@@ -1,9 +1,13 @@
 import gzip
-import itertools
+import hashlib
+import importlib.util
 import json
+import multiprocessing
 import os
 import re
 
+from . import cube_format
+
 
 def load_output_classification_details(all_classifications):
     with open('input-txt-files/output-classifications-with-details.json', 'r') as f:
@@ -44,12 +48,153 @@ def load_input_and_output_classification_codes():
 
 
 def read_json_gz(filename):
+    """Read a downloaded file, from `filename` or, if that does not exist, from
+    the corresponding compact file (see `cube_format`)."""
+    if not os.path.isfile(filename) and os.path.isfile(cube_format.compact_path(filename)):
+        return cube_format.read_compact_file(cube_format.compact_path(filename))
     with gzip.open(filename, 'r') as f:
         json_bytes = f.read()
     return json.loads(json_bytes.decode('utf-8'))
 
 
-def generate_outfile_path(cc, category_list, directory_pattern, suffix):
+def iter_observations(filename, skip_zeros=False):
+    """Yield the observations in a downloaded file (see `read_json_gz`) one at a time.
+
+    Unlike `read_json_gz`, this never holds the whole response in memory. Nothing is
+    yielded if the response's observations are null.  If `skip_zeros` is True, observations
+    whose count is zero are left out.
+    """
+    if not os.path.isfile(filename) and os.path.isfile(cube_format.compact_path(filename)):
+        yield from cube_format.iter_compact_observations(cube_format.compact_path(filename), skip_zeros)
+        return
+    with gzip.open(filename, 'rt', encoding='utf-8') as f:
+        for obs in _iter_json_observations(_JsonStreamReader(f)):
+            if obs['observation'] != 0 or not skip_zeros:
+                yield obs
+
+
+class _JsonStreamReader:
+    """Reads JSON values one at a time from a text file, holding only a small buffer in memory."""
+
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def read_more(self):
+        chunk = self.f.read(self.chunk_size)
+        if chunk == '':
+            raise ValueError('Unexpected end of JSON file')
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+
+    def next_char(self):
+        """Skip whitespace and return the next character, without consuming it."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            self.read_more()
+
+    def expect(self, char):
+        if self.next_char() != char:
+            raise ValueError('Expected {!r} in JSON file'.format(char))
+        self.pos += 1
+
+    def value(self):
+        self.next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # The value may continue beyond the end of the buffer
+                self.read_more()
+                continue
+            if end == len(self.buffer) and not isinstance(value, (dict, list, str)):
+                # A number at the end of the buffer may be incomplete
+                try:
+                    self.read_more()
+                    continue
+                except ValueError:
+                    pass
+            self.pos = end
+            return value
+
+
+def _iter_json_observations(reader):
+    reader.expect('{')
+    if reader.next_char() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'observations' and reader.next_char() == '[':
+            reader.expect('[')
+            if reader.next_char() != ']':
+                while True:
+                    yield reader.value()
+                    if reader.next_char() == ']':
+                        break
+                    reader.expect(',')
+            reader.expect(']')
+        else:
+            reader.value()
+        if reader.next_char() == '}':
+            return
+        reader.expect(',')
+
+
+def download_exists(compressed_file_path):
+    """Return True if a downloaded file exists at `compressed_file_path`, in either format."""
+    return os.path.isfile(compressed_file_path) or os.path.isfile(cube_format.compact_path(compressed_file_path))
+
+
+def is_skipped_download(filename, config):
+    """Return True if a download should be skipped because --skip-existing was given (according to
+    the config object `config`), the file exists, and it is not in `config["invalid_files"]`, the
+    files that failed validation."""
+    return (
+        config["skip_existing_files"] and download_exists(filename)
+        and filename not in config["invalid_files"]
+    )
+
+
+def save_download(compressed_file_path, response_bytes, compact=False, keep_json=False):
+    """Save a response from the API.
+
+    Parameters
+    ----------
+    compressed_file_path : str
+        The target .json.gz filename
+    response_bytes : bytes
+        The JSON response
+    compact : bool
+        If True, save the response in the compact format (see `cube_format`) instead
+    keep_json : bool
+        If True and `compact` is True, save the gzipped JSON as well
+    """
+    if compact:
+        try:
+            data = json.loads(response_bytes.decode('utf-8'))
+        except ValueError:
+            # Not a JSON response from the API (e.g. an error page), so keep it as it is
+            compact = False
+    if compact:
+        cube_format.write_compact_file(cube_format.compact_path(compressed_file_path), data)
+    elif os.path.isfile(cube_format.compact_path(compressed_file_path)):
+        os.remove(cube_format.compact_path(compressed_file_path))
+    if not compact or keep_json:
+        with gzip.open(compressed_file_path, 'wb') as f:
+            f.write(response_bytes)
+    elif os.path.isfile(compressed_file_path):
+        # read_json_gz() would otherwise read the out-of-date JSON file
+        os.remove(compressed_file_path)
+
+
+def generate_outfile_path(cc, category_list, directory_pattern, suffix, create_directory=True):
     if len(cc) == 0:
         raise ValueError("cc should have at least one element.")
     if len(cc) != len(category_list) + 1:
@@ -57,13 +202,324 @@ def generate_outfile_path(cc, category_list, directory_pattern, suffix):
 
     directory_names = [cat_id + '-' + opt['id'] for cat_id, opt in zip(cc, category_list)]
     directory = directory_pattern.format(len(cc), '/'.join(directory_names))
-    os.makedirs(directory, exist_ok=True)
+    if create_directory:
+        os.makedirs(directory, exist_ok=True)
     return directory + '/' + cc[-1] + suffix
 
 
-def get_config(filename, key):
+def new_dedup_store(mode, blob_directory='generated/blobs'):
+    """Create a store for writing generated files with content-addressed deduplication.
+
+    Each distinct payload is written once to `blob_directory`, named by its SHA-256 hash.
+
+    Parameters
+    ----------
+    mode : str
+        'hardlink' to hard-link every output path to its blob, so that the tree can be
+        read as usual; or 'manifest' to write only the blobs and record each output path
+        in the manifest
+    blob_directory : str
+        The directory in which unique payloads are stored
+
+    Returns
+    -------
+    dict
+        The store, to be passed to `write_json_file`. Its counts of unique and duplicate
+        files are relative to the payloads written with this store, not to the blobs on disk.
+    """
+    if mode not in ['hardlink', 'manifest']:
+        raise ValueError("Unrecognised deduplication mode: " + mode)
+    os.makedirs(blob_directory, exist_ok=True)
+    return {
+        "mode": mode,
+        "blob_directory": blob_directory,
+        "manifest": {},
+        # A map from the hash of each payload written with this store to its size
+        "blob_sizes": {},
+        "unique_files": 0,
+        "duplicate_files": 0,
+        "bytes_written": 0,
+        "bytes_saved": 0
+    }
+
+
+def dedup_store_from_args(args):
+    """Return a dedup store if `--dedup=hardlink` or `--dedup=manifest` is in `args`, or None otherwise."""
+    for arg in args:
+        if arg.startswith('--dedup='):
+            return new_dedup_store(arg[len('--dedup='):])
+    return None
+
+
+def write_bytes_file(filename, payload, dedup_store=None):
+    """Write `payload` to `filename`, deduplicating it if `dedup_store` is given.
+
+    Parameters
+    ----------
+    filename : str
+        The output path
+    payload : bytes
+        The file contents
+    dedup_store : dict or None
+        A store created by `new_dedup_store`
+    """
+    # Don't write through a hard link to a blob that other paths share, and in manifest mode
+    # don't leave a stale file at a path that the manifest maps to a blob
+    manifest_mode = dedup_store is not None and dedup_store["mode"] == 'manifest'
+    if os.path.isfile(filename) and (manifest_mode or os.stat(filename).st_nlink > 1):
+        os.remove(filename)
+    if dedup_store is None:
+        with open(filename, 'wb') as f:
+            f.write(payload)
+        return
+    digest = hashlib.sha256(payload).hexdigest()
+    blob_path = os.path.join(dedup_store["blob_directory"], digest + '.json')
+    if digest in dedup_store["blob_sizes"]:
+        dedup_store["duplicate_files"] += 1
+        dedup_store["bytes_saved"] += len(payload)
+    else:
+        # The blob may be left from an earlier run
+        if not os.path.isfile(blob_path):
+            temp_path = '{}.{}.tmp'.format(blob_path, os.getpid())
+            with open(temp_path, 'wb') as f:
+                f.write(payload)
+            os.replace(temp_path, blob_path)
+        dedup_store["blob_sizes"][digest] = len(payload)
+        dedup_store["unique_files"] += 1
+        dedup_store["bytes_written"] += len(payload)
+    dedup_store["manifest"][filename] = digest
+    if dedup_store["mode"] == 'hardlink':
+        if os.path.isfile(filename):
+            os.remove(filename)
+        os.link(blob_path, filename)
+
+
+def write_json_file(filename, data, dedup_store=None):
+    """Serialise `data` as JSON and write it to `filename` (see `write_bytes_file`)."""
+    write_bytes_file(filename, json.dumps(data).encode('utf-8'), dedup_store)
+
+
+def save_dedup_manifest(dedup_store, filename='generated/dedup-manifest.json'):
+    """Merge the path-to-hash manifest of `dedup_store` into the manifest file `filename`,
+    and remove the blobs that no path in the merged manifest refers to.
+
+    Paths that now exist as files other than their blob (for example because a later run
+    wrote them without deduplication) are dropped from the manifest.
+
+    Returns
+    -------
+    int
+        The number of blobs removed
+    """
+    manifest = {}
+    if os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            manifest = json.load(f)["files"]
+    manifest.update(dedup_store["manifest"])
+    for path, digest in list(manifest.items()):
+        blob_path = os.path.join(dedup_store["blob_directory"], digest + '.json')
+        if os.path.isfile(path) and not (os.path.isfile(blob_path) and os.path.samefile(path, blob_path)):
+            del manifest[path]
+    with open(filename, 'w') as f:
+        json.dump({"blob_directory": dedup_store["blob_directory"], "files": manifest}, f)
+
+    referenced = set(manifest.values())
+    removed_count = 0
+    with os.scandir(dedup_store["blob_directory"]) as entries:
+        for entry in entries:
+            if entry.name.endswith('.json') and entry.name[:-len('.json')] not in referenced:
+                os.remove(entry.path)
+                removed_count += 1
+    return removed_count
+
+
+def dedup_blob_paths(filename='generated/dedup-manifest.json'):
+    """Return a map from each (normalised) path in the manifest file `filename` to the path of its blob,
+    or an empty map if there is no manifest."""
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as f:
+        manifest = json.load(f)
+    return {
+        os.path.normpath(path): os.path.join(manifest["blob_directory"], digest + '.json')
+        for path, digest in manifest["files"].items()
+    }
+
+
+def print_dedup_report(dedup_store, removed_blob_count=0):
+    print("Deduplication: {} unique files ({} bytes) written; {} duplicates ({} bytes) saved; {} unused blobs removed"
+          .format(dedup_store["unique_files"], dedup_store["bytes_written"],
+                  dedup_store["duplicate_files"], dedup_store["bytes_saved"], removed_blob_count))
+
+
+def merge_dedup_stores(dedup_store, other):
+    """Add the manifest entries of `other` (e.g. from a worker process) to `dedup_store`.
+
+    Each entry is counted as a unique or duplicate file according to the payloads already in
+    `dedup_store`, so the counts are the same as if every file had been written with `dedup_store`.
+    """
+    for filename, digest in other["manifest"].items():
+        size = other["blob_sizes"][digest]
+        if digest in dedup_store["blob_sizes"]:
+            dedup_store["duplicate_files"] += 1
+            dedup_store["bytes_saved"] += size
+        else:
+            dedup_store["blob_sizes"][digest] = size
+            dedup_store["unique_files"] += 1
+            dedup_store["bytes_written"] += size
+        dedup_store["manifest"][filename] = digest
+
+
+def is_up_to_date(filename, source_filenames):
+    """Return True if `filename` exists and is newer than all of `source_filenames`.
+
+    The ctime of each source is also compared, because a deduplicated file is a hard link
+    to a blob whose mtime may predate the link.
+    """
+    if not os.path.isfile(filename):
+        return False
+    mtime = os.stat(filename).st_mtime_ns
+    for source_filename in source_filenames:
+        st = os.stat(source_filename)
+        if max(st.st_mtime_ns, st.st_ctime_ns) >= mtime:
+            return False
+    return True
+
+
+def combine_json_files(pair, dedup_mode=None, blob_directory='generated/blobs', force=False):
+    """Write the bar chart file and map file for a set of input selections to a single combined file.
+
+    The files' bytes are spliced into the combined object without parsing them, giving the
+    same output as serialising `{"bar_chart_data": ..., "map_data": ...}` with `json.dumps`.
+
+    Parameters
+    ----------
+    pair : tuple
+        The filenames of the national-level (bar chart) file, the LTLA-level (map) file and the output
+    dedup_mode : str or None
+        The mode of the dedup store (see `new_dedup_store`), if files should be deduplicated
+    blob_directory : str
+        The blob directory of the dedup store
+    force : bool
+        If False, the output is not rewritten if it is newer than both inputs
+
+    Returns
+    -------
+    bool, dict or None
+        Whether the file was written, and a dedup store recording the write (or None)
+    """
+    bar_chart_filename, map_filename, combined_filename = pair
+    if not force and is_up_to_date(combined_filename, [bar_chart_filename, map_filename]):
+        return False, None
+    with open(bar_chart_filename, 'rb') as f:
+        bar_chart_data = f.read().strip()
+    with open(map_filename, 'rb') as f:
+        map_data = f.read().strip()
+    payload = b''.join([b'{"bar_chart_data": ', bar_chart_data, b', "map_data": ', map_data, b'}'])
+    dedup_store = None if dedup_mode is None else new_dedup_store(dedup_mode, blob_directory)
+    os.makedirs(os.path.dirname(combined_filename), exist_ok=True)
+    write_bytes_file(combined_filename, payload, dedup_store)
+    return True, dedup_store
+
+
+def hash_file(filename):
+    """Return the SHA-256 hex digest of the contents of `filename`."""
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def walk_files(root, exclude=()):
+    """Yield the path of every file under `root`, lazily and in no particular order,
+    skipping the files and directories whose paths (starting with `root`) are in `exclude`."""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.path in exclude:
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from walk_files(entry.path, exclude)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path
+
+
+def build_file_manifest(root, processes=None, exclude=()):
+    """Hash every file under `root` in parallel.
+
+    Files that are hard links to the same inode (see `new_dedup_store`) are only hashed once.
+
+    Parameters
+    ----------
+    root : str
+        The directory to hash, for example 'generated'
+    processes : int or None
+        The number of worker processes; None means one per CPU
+    exclude : collection of str
+        Files and directories to leave out, relative to `root`
+
+    Returns
+    -------
+    dict
+        A map from each file's path relative to `root` (with '/' separators) to its SHA-256 hash
+    """
+    paths_by_inode = {}
+    for path in walk_files(root, {os.path.join(root, path) for path in exclude}):
+        st = os.stat(path)
+        paths_by_inode.setdefault((st.st_dev, st.st_ino), []).append(path)
+    inode_paths = [paths[0] for paths in paths_by_inode.values()]
+    if processes == 1:
+        digests = map(hash_file, inode_paths)
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            digests = pool.map(hash_file, inode_paths, chunksize=256)
+    manifest = {}
+    for paths, digest in zip(paths_by_inode.values(), digests):
+        for path in paths:
+            manifest[os.path.relpath(path, root).replace(os.sep, '/')] = digest
+    return manifest
+
+
+def diff_file_manifests(old_manifest, new_manifest):
+    """Compare two manifests from `build_file_manifest`.
+
+    Returns
+    -------
+    dict
+        Sorted lists of 'added', 'changed' and 'removed' paths
+    """
+    return {
+        "added": sorted(path for path in new_manifest if path not in old_manifest),
+        "changed": sorted(
+            path for path in new_manifest
+            if path in old_manifest and new_manifest[path] != old_manifest[path]
+        ),
+        "removed": sorted(path for path in old_manifest if path not in new_manifest)
+    }
+
+
+def load_script(filename):
+    """Import one of the scripts in the python-scripts directory (e.g. 'generate-files.py') as a module.
+
+    The script's main() is not run.
+    """
+    scripts_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    module_name = os.path.splitext(filename)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(scripts_directory, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_config(filename, key, default=None):
+    """Return the value of `key` in the JSON config file `filename`.
+
+    If `default` is not None, it is returned when the key is missing.
+    """
     with open(filename, "r") as f:
         config = json.load(f)
+    if default is not None and key not in config:
+        return default
     return config[key]
 
 
@@ -71,12 +527,178 @@ def remove_classification_number(c):
     return re.sub(r'(_detailed)?_[0-9]{1,3}[a-z]$', '', c)
 
 
+def family_disjoint_combinations(family_ids, num_vars, start=0, used_family_ids=()):
+    """Yield, in the order of `itertools.combinations`, each tuple of `num_vars` indices into `family_ids`
+    such that no two of the indices have the same family ID."""
+    if num_vars == 0:
+        yield ()
+        return
+    for i in range(start, len(family_ids) - num_vars + 1):
+        if family_ids[i] in used_family_ids:
+            continue
+        for rest in family_disjoint_combinations(family_ids, num_vars - 1, i + 1, used_family_ids + (family_ids[i],)):
+            yield (i,) + rest
+
+
 def get_input_classification_combinations(input_classifications, num_vars):
-    result = []
-    for cc in itertools.combinations(input_classifications, num_vars):
-        classification_families = [remove_classification_number(c) for c in cc]
-        if len(classification_families) == len(set(classification_families)):
-            result.append(cc)
+    family_ids = [remove_classification_number(c) for c in input_classifications]
+    return [
+        tuple(input_classifications[i] for i in indices)
+        for indices in family_disjoint_combinations(family_ids, num_vars)
+    ]
+
+
+def build_combination_index(input_classifications, output_classifications, max_var_selections, household_flags):
+    """Build an index of the valid input classification combinations at each level, with the
+    files to download and read for each combination.
+
+    Parameters
+    ----------
+    input_classifications : list
+        The sorted input classification codes
+    output_classifications : list
+        The sorted output classification codes
+    max_var_selections : int
+        The maximum number of input classifications in a combination
+    household_flags : dict
+        A map from classification code to True for household variables
+
+    Returns
+    -------
+    dict
+        'families' maps each classification family to an integer ID, and 'levels' is a list
+        with one element for each number of input classifications from 0 to `max_var_selections`.
+        Each element is a list of combinations, which are dicts with the following keys:
+
+        cc            the input classification combination
+        family_ids    the family ID of each element of cc
+        total_path    the downloaded file of totals for cc (None if cc is empty)
+        ltla_path     the downloaded LTLA-level file for cc (None if cc is empty)
+        outputs       a list with a dict for each output classification c that can be used
+                      with cc, with keys 'c'; 'path' (the downloaded file with the data for
+                      cc and c); 'poptype'; and 'download', which is False if the file is
+                      downloaded for a smaller combination.  (The API won't give data for two
+                      versions of the same variable, but for a resident_age output we use the
+                      data with the resident_age input removed.)
+    """
+    families = {}
+    for c in input_classifications + output_classifications:
+        families.setdefault(remove_classification_number(c), len(families))
+    input_family_ids = [families[remove_classification_number(c)] for c in input_classifications]
+    resident_age_id = families.get("resident_age")
+
+    levels = []
+    for num_vars in range(0, max_var_selections + 1):
+        combinations = []
+        for indices in family_disjoint_combinations(input_family_ids, num_vars):
+            cc = [input_classifications[i] for i in indices]
+            family_ids = [input_family_ids[i] for i in indices]
+            outputs = []
+            for c in output_classifications:
+                c_family_id = families[remove_classification_number(c)]
+                if c_family_id == resident_age_id:
+                    classifications = [c_ for c_, f in zip(cc, family_ids) if f != resident_age_id] + [c]
+                elif c_family_id in family_ids:
+                    continue
+                else:
+                    classifications = cc + [c]
+                outputs.append({
+                    "c": c,
+                    "path": 'downloaded/{}var/{}.json.gz'.format(len(classifications) - 1, "-".join(classifications)),
+                    "poptype": "UR_HH" if household_flags[c] else "UR",
+                    "download": c_family_id not in family_ids
+                })
+            combinations.append({
+                "cc": cc,
+                "family_ids": family_ids,
+                "total_path": 'downloaded/{}var/{}.json.gz'.format(num_vars, "-".join(cc)) if num_vars > 0 else None,
+                "ltla_path": (
+                    'downloaded/{}var-by-ltla/{}_by_geog.json.gz'.format(num_vars, "-".join(cc)) if num_vars > 0 else None
+                ),
+                "outputs": outputs
+            })
+        levels.append(combinations)
+    return {"families": families, "levels": levels}
+
+
+def bundle_output_classifications(cc, output_classifications, category_counts, families, max_outputs, max_cells):
+    """Group output classifications into bundles that can be downloaded together as one cube.
+
+    Classifications are added to a bundle in order until adding another one would take it
+    over `max_outputs` classifications or over `max_cells` cells, or would put two
+    classifications of the same family in the cube (which the API does not allow).
+
+    Parameters
+    ----------
+    cc : list
+        The input classification combination
+    output_classifications : list
+        The output classifications to group
+    category_counts : dict
+        A map from classification code to number of categories
+    families : dict
+        A map from classification code to classification family (see `remove_classification_number`)
+    max_outputs : int
+        The maximum number of output classifications in a bundle
+    max_cells : int
+        The maximum number of cells in the cube for a bundle
+
+    Returns
+    -------
+    list
+        A list of bundles, each of which is a list of output classifications
+    """
+    base_cells = 1
+    for c in cc:
+        base_cells *= category_counts[c]
+    cc_families = {families[c] for c in cc}
+    bundles = []
+    bundle = []
+    cells = base_cells
+    for c in output_classifications:
+        bundle_families = {families[c_] for c_ in bundle}
+        # An output of the same family as an input is left in a bundle of its own
+        if len(bundle) > 0 and (
+            len(bundle) == max_outputs or cells * category_counts[c] > max_cells
+            or families[c] in bundle_families or (bundle_families | {families[c]}) & cc_families
+        ):
+            bundles.append(bundle)
+            bundle = []
+            cells = base_cells
+        bundle.append(c)
+        cells *= category_counts[c]
+    if len(bundle) > 0:
+        bundles.append(bundle)
+    return bundles
+
+
+def marginalise_response(data, dimension_ids):
+    """Sum the counts in an API response over all dimensions except those in `dimension_ids`.
+
+    Parameters
+    ----------
+    data : dict
+        A dictionary created from an unblocked JSON response from the Census API
+    dimension_ids : list
+        The IDs of the dimensions to keep, including the geography dimension
+
+    Returns
+    -------
+    dict
+        A dictionary in the same format as `data`, as if the API had been asked for
+        `dimension_ids` only
+    """
+    observations = {}
+    for obs in data['observations']:
+        dimensions = [dim for dim in obs['dimensions'] if dim['dimension_id'] in dimension_ids]
+        key = tuple(dim['option_id'] for dim in dimensions)
+        if key not in observations:
+            observations[key] = {'dimensions': dimensions, 'observation': 0}
+        observations[key]['observation'] += obs['observation']
+    result = dict(data)
+    result['observations'] = list(observations.values())
+    if 'total_observations' in result:
+        result['total_observations'] = len(observations)
     return result
 
 
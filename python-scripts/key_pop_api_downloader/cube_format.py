@@ -0,0 +1,223 @@
+"""A compact on-disk format for Census API responses.
+
+A compact file is an LZMA-compressed JSON header line, which holds the response's
+top-level fields and the list of options for each dimension, followed by a packed
+little-endian array of counts with one element per cell of the cube in row-major
+order.  Cells that were absent from the response are stored as -1.
+
+Cubes that are mostly zeros are instead stored in coordinate (COO) form: an array of the
+indices of the non-zero cells followed by an array of their counts, with every other cell
+being zero.  The encoder uses whichever form is smaller.
+"""
+
+import array
+import json
+import lzma
+import sys
+
+FORMAT_NAME = 'key-pop-cube'
+FORMAT_VERSION = 2
+# Version 1 files, which are always dense, can still be read
+READABLE_FORMAT_VERSIONS = [1, 2]
+COMPACT_SUFFIX = '.cube.xz'
+
+
+def compact_path(compressed_file_path):
+    """Return the path of the compact file that corresponds to a .json.gz file path."""
+    if compressed_file_path.endswith('.json.gz'):
+        return compressed_file_path[:-len('.json.gz')] + COMPACT_SUFFIX
+    return compressed_file_path + COMPACT_SUFFIX
+
+
+def smallest_typecode(values):
+    """Return the smallest signed array typecode that can hold every element of `values` and -1."""
+    largest = max(values, default=0)
+    for typecode in ['b', 'h', 'i', 'q']:
+        if largest < 1 << (8 * array.array(typecode).itemsize - 1):
+            return typecode
+    raise ValueError('Count too large to pack: {}'.format(largest))
+
+
+def encode_response(data, encoding=None):
+    """Encode a dictionary created from a Census API JSON response in the compact format.
+
+    Parameters
+    ----------
+    data : dict
+        The response
+    encoding : str or None
+        'dense' or 'coo', or None to use whichever is smaller
+
+    Returns
+    -------
+    bytes
+        The compressed, encoded response
+    """
+    header = {
+        "format": FORMAT_NAME,
+        "version": FORMAT_VERSION,
+        "fields": {key: val for key, val in data.items() if key != 'observations'},
+        "dimensions": None,
+        "encoding": "dense"
+    }
+    counts = array.array('b')
+    nonzero_indices = array.array('b')
+    if data.get('observations') is not None:
+        dimensions = []
+        option_indices = []
+        for obs in data['observations']:
+            if len(dimensions) == 0:
+                dimensions = [
+                    {"dimension_id": dim['dimension_id'], "label": dim.get('dimension'), "options": []}
+                    for dim in obs['dimensions']
+                ]
+                option_indices = [{} for _ in dimensions]
+            for dimension, indices, dim in zip(dimensions, option_indices, obs['dimensions']):
+                if dim['option_id'] not in indices:
+                    indices[dim['option_id']] = len(dimension['options'])
+                    dimension['options'].append([dim['option_id'], dim.get('option')])
+        cells = [-1] * _cell_count(dimensions)
+        for obs in data['observations']:
+            cells[_cell_index(option_indices, obs['dimensions'])] = obs['observation']
+        header["dimensions"] = dimensions
+        counts = array.array(smallest_typecode(cells), cells)
+        # Missing cells (-1) are "non-zero" here, so that they are kept in COO form
+        nonzero_cells = [cell for cell, count in enumerate(cells) if count != 0]
+        index_typecode = smallest_typecode(nonzero_cells)
+        index_size = array.array(index_typecode).itemsize
+        if encoding is None:
+            coo_is_smaller = len(nonzero_cells) * (index_size + counts.itemsize) < len(cells) * counts.itemsize
+            encoding = 'coo' if coo_is_smaller else 'dense'
+        if encoding == 'coo':
+            header["encoding"] = "coo"
+            header["index_typecode"] = index_typecode
+            header["nonzero_count"] = len(nonzero_cells)
+            nonzero_indices = array.array(index_typecode, nonzero_cells)
+            counts = array.array(counts.typecode, [cells[cell] for cell in nonzero_cells])
+    header["typecode"] = counts.typecode
+    if sys.byteorder == 'big':
+        counts.byteswap()
+        nonzero_indices.byteswap()
+    body = counts.tobytes()
+    if header["encoding"] == "coo":
+        body = nonzero_indices.tobytes() + body
+    return lzma.compress(json.dumps(header).encode('utf-8') + b'\n' + body)
+
+
+def decode_response(payload):
+    """Decode a response encoded with `encode_response`.
+
+    Returns
+    -------
+    dict
+        A dictionary in the same format as the original JSON response
+    """
+    header, cells = _decode_header_and_cells(payload)
+    data = dict(header["fields"])
+    if header["dimensions"] is None:
+        data['observations'] = None
+        return data
+    data['observations'] = list(_iter_observations(header["dimensions"], cells))
+    return data
+
+
+def iter_compact_observations(filename, skip_zeros=False):
+    """Yield the observations in a compact file one at a time, as they would appear in the JSON response.
+
+    If `skip_zeros` is True, observations whose count is zero are left out; for a
+    COO-encoded file, the zero cells are then never visited.
+    """
+    with open(filename, 'rb') as f:
+        header, cells = _decode_header_and_cells(f.read(), skip_zeros)
+    if header["dimensions"] is not None:
+        yield from _iter_observations(header["dimensions"], cells)
+
+
+def _decode_header_and_cells(payload, skip_zeros=False):
+    """Return the header and an iterable of (cell index, count) pairs, in order of cell index."""
+    raw = lzma.decompress(payload)
+    header_end = raw.index(b'\n')
+    header = json.loads(raw[:header_end].decode('utf-8'))
+    if header.get("format") != FORMAT_NAME or header.get("version") not in READABLE_FORMAT_VERSIONS:
+        raise ValueError('Not a compact cube file')
+    body = raw[header_end + 1:]
+    if header.get("encoding", "dense") == "coo":
+        indices = array.array(header["index_typecode"])
+        indices_size = header["nonzero_count"] * indices.itemsize
+        indices.frombytes(body[:indices_size])
+        body = body[indices_size:]
+    counts = array.array(header["typecode"])
+    counts.frombytes(body)
+    if sys.byteorder == 'big':
+        counts.byteswap()
+    if header.get("encoding", "dense") != "coo":
+        cells = enumerate(counts)
+    else:
+        if sys.byteorder == 'big':
+            indices.byteswap()
+        if skip_zeros:
+            cells = zip(indices, counts)
+        else:
+            cells = _expand_coo(indices, counts, _cell_count(header["dimensions"]))
+    if skip_zeros:
+        cells = ((cell, count) for cell, count in cells if count != 0)
+    return header, cells
+
+
+def _expand_coo(indices, counts, cell_count):
+    next_cell = 0
+    for cell, count in zip(indices, counts):
+        for zero_cell in range(next_cell, cell):
+            yield zero_cell, 0
+        yield cell, count
+        next_cell = cell + 1
+    for zero_cell in range(next_cell, cell_count):
+        yield zero_cell, 0
+
+
+def _iter_observations(dimensions, cells):
+    for cell, count in cells:
+        if count == -1:
+            continue
+        obs_dimensions = []
+        for dimension, option_index in zip(dimensions, _cell_option_indices(dimensions, cell)):
+            option_id, option_label = dimension['options'][option_index]
+            dim = {"dimension_id": dimension['dimension_id'], "option_id": option_id}
+            if dimension['label'] is not None:
+                dim["dimension"] = dimension['label']
+            if option_label is not None:
+                dim["option"] = option_label
+            obs_dimensions.append(dim)
+        yield {"dimensions": obs_dimensions, "observation": count}
+
+
+def write_compact_file(filename, data):
+    with open(filename, 'wb') as f:
+        f.write(encode_response(data))
+
+
+def read_compact_file(filename):
+    with open(filename, 'rb') as f:
+        return decode_response(f.read())
+
+
+def _cell_count(dimensions):
+    result = 1
+    for dimension in dimensions:
+        result *= len(dimension['options'])
+    return result
+
+
+def _cell_index(option_indices, obs_dimensions):
+    index = 0
+    for indices, dim in zip(option_indices, obs_dimensions):
+        index = index * len(indices) + indices[dim['option_id']]
+    return index
+
+
+def _cell_option_indices(dimensions, cell):
+    result = []
+    for dimension in reversed(dimensions):
+        cell, option_index = divmod(cell, len(dimension['options']))
+        result.append(option_index)
+    return result[::-1]
@@ -0,0 +1,192 @@
+"""Lazily loaded classification metadata, cached in a snapshot file between runs.
+
+The first call to any of the functions below loads the metadata, either from the
+snapshot or, if any of the source files has changed since the snapshot was made,
+from the source files (in which case a new snapshot is saved).
+"""
+
+import hashlib
+import json
+import os
+import pickle
+
+from . import (
+    build_combination_index, get_config, load_all_classifications, load_output_classification_details,
+    remove_classification_number
+)
+
+SNAPSHOT_FILENAME = 'downloaded/metadata-snapshot.pickle'
+SNAPSHOT_VERSION = 3
+SOURCE_FILENAMES = [
+    'generated/all-classifications.json',
+    'input-txt-files/config.json',
+    'input-txt-files/input-classifications.txt',
+    'input-txt-files/output-classifications-with-details.json'
+]
+HOUSEHOLD_VAR_PREFIXES = [
+    'hh_', 'accommodation_type', 'number_bedrooms', 'occupancy_rating_bedrooms',
+    'number_of_cars', 'heating_type'
+]
+
+_metadata = None
+_ltlas = None
+
+
+def get_metadata():
+    """Return a dictionary of all metadata, loading it if necessary."""
+    global _metadata
+    if _metadata is None:
+        _metadata = load_snapshot(SNAPSHOT_FILENAME)
+        if _metadata is None:
+            _metadata = build_metadata()
+            save_snapshot(_metadata, SNAPSHOT_FILENAME)
+    return _metadata
+
+
+def reset():
+    """Forget the loaded metadata, so that it is reloaded (e.g. after the source files are regenerated)."""
+    global _metadata, _ltlas
+    _metadata = None
+    _ltlas = None
+
+
+def all_classifications():
+    """The details of all classifications, as returned by `load_all_classifications`."""
+    return get_metadata()["all_classifications"]
+
+
+def output_classification_details():
+    """A map from output classification code to details, as returned by `load_output_classification_details`."""
+    return get_metadata()["output_classification_details"]
+
+
+def input_and_output_classification_codes():
+    """The sorted lists of input and output classification codes."""
+    return get_metadata()["input_classifications"], get_metadata()["output_classifications"]
+
+
+def is_household_var(classification_code):
+    """Return True if and only if classification_code is for a household variable."""
+    return get_metadata()["household_flags"][classification_code]
+
+
+def classification_family(classification_code):
+    """Return the classification code without its number (see `remove_classification_number`)."""
+    families = get_metadata()["families"]
+    if classification_code in families:
+        return families[classification_code]
+    return remove_classification_number(classification_code)
+
+
+def category_index(classification_code, category_id):
+    """Return the position of the category with ID `category_id` in the list of categories of a classification."""
+    return get_metadata()["category_indices"][classification_code][category_id]
+
+
+def combination_index():
+    """The index of input classification combinations (see `build_combination_index`)."""
+    return get_metadata()["combination_index"]
+
+
+def combinations(num_vars):
+    """The entries of the combination index for combinations of `num_vars` input classifications."""
+    return get_metadata()["combination_index"]["levels"][num_vars]
+
+
+def ltlas():
+    """The list of LTLA codes from downloaded/ltla-geog.json."""
+    global _ltlas
+    if _ltlas is None:
+        with open('downloaded/ltla-geog.json', 'r') as f:
+            _ltlas = [item["id"] for item in json.load(f)["items"]]
+    return _ltlas
+
+
+def build_metadata():
+    """Load the metadata from the source files and precompute derived indexes."""
+    with open('input-txt-files/input-classifications.txt', 'r') as f:
+        input_classifications = sorted(f.read().splitlines())
+    classifications = load_all_classifications()
+    output_details = load_output_classification_details(classifications)
+    output_classifications = sorted(output_details)
+
+    household_flags = {}
+    for code, classification in classifications.items():
+        household_flags[code] = 'UR' not in classification['poptypes']
+    for code in input_classifications + output_classifications:
+        expected_result = any(code.startswith(prefix) for prefix in HOUSEHOLD_VAR_PREFIXES)
+        if expected_result != household_flags[code]:
+            # To be extra-cautious, we test it two ways and make sure they're consistent
+            raise Exception('Unexpected is_household_var() result for ' + code)
+
+    max_var_selections = get_config('input-txt-files/config.json', 'max_var_selections')
+
+    return {
+        "version": SNAPSHOT_VERSION,
+        "sources": {filename: source_signature(filename) for filename in SOURCE_FILENAMES},
+        "all_classifications": classifications,
+        "output_classification_details": output_details,
+        "input_classifications": input_classifications,
+        "output_classifications": output_classifications,
+        "household_flags": household_flags,
+        "families": {code: remove_classification_number(code) for code in classifications},
+        "category_indices": {
+            code: {cat['id']: i for i, cat in enumerate(classification['categories'])}
+            for code, classification in classifications.items()
+        },
+        "combination_index": build_combination_index(
+            input_classifications, output_classifications, max_var_selections, household_flags
+        )
+    }
+
+
+def source_signature(filename, with_hash=True):
+    st = os.stat(filename)
+    signature = {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+    if with_hash:
+        with open(filename, 'rb') as f:
+            signature["sha256"] = hashlib.sha256(f.read()).hexdigest()
+    return signature
+
+
+def snapshot_is_current(snapshot):
+    """Return True if none of the source files has changed since `snapshot` was built.
+
+    Files whose modification time and size are unchanged are assumed to be unchanged;
+    otherwise the file's hash is compared.
+    """
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return False
+    for filename in SOURCE_FILENAMES:
+        saved = snapshot["sources"].get(filename)
+        if saved is None or not os.path.isfile(filename):
+            return False
+        current = source_signature(filename, with_hash=False)
+        if current["mtime_ns"] == saved["mtime_ns"] and current["size"] == saved["size"]:
+            continue
+        if source_signature(filename)["sha256"] != saved["sha256"]:
+            return False
+    return True
+
+
+def load_snapshot(filename):
+    """Return the metadata saved in `filename`, or None if it is missing or out of date."""
+    if not os.path.isfile(filename):
+        return None
+    try:
+        with open(filename, 'rb') as f:
+            snapshot = pickle.load(f)
+    except (pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+    if not snapshot_is_current(snapshot):
+        return None
+    return snapshot
+
+
+def save_snapshot(metadata, filename):
+    if not os.path.isdir(os.path.dirname(filename)):
+        return
+    temp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp_filename, 'wb') as f:
+        pickle.dump(metadata, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filename, filename)
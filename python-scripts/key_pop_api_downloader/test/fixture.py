@@ -0,0 +1,247 @@
+"""A small, fixed synthetic copy of the downloaded files, for checking that the generated files don't change.
+
+The cubes are counts of a fixed random population of usual residents. The classifications
+include resident_age inputs and outputs with different bands, a household classification,
+national cubes that the API would block, LTLA-level cubes with one blocked area and
+3-variable LTLA-level cubes that are blocked entirely (`blocked_areas == 331`).
+
+Run `python -m key_pop_api_downloader.test.fixture DIRECTORY` in python-scripts to build it.
+"""
+
+import gzip
+import itertools
+import json
+import os
+import random
+import sys
+
+SEED = 1234
+POPULATION_SIZE = 20000
+# As many LTLAs as the API has, so that the LTLA-level files are full-sized
+LTLAS = ['E06{:06d}'.format(i) for i in range(1, 331)] + ['W06000001']
+# Blocked from the 2-variable LTLA-level cubes
+BLOCKED_LTLA = 'W06000001'
+INPUT_CLASSIFICATIONS = ['ethnic_group_tb_3a', 'religion_tb_9a', 'resident_age_18b', 'resident_age_3a', 'sex']
+OUTPUT_CLASSIFICATIONS = [
+    {"code": "sex", "label": None, "categories": None, "bacap_code": "sex", "populationBase": "all people"},
+    {"code": "resident_age_6a", "label": None, "categories": [
+        {"label": "Aged 15 years and under", "cells": [1, 2]},
+        {"label": "Aged 16 to 24 years", "cells": [3]},
+        {"label": "Aged 25 to 64 years", "cells": [4, 5]},
+        {"label": "Aged 65 years and over", "cells": [6]}
+    ], "bacap_code": "resident_age", "populationBase": "all people"},
+    {"code": "resident_age_4x", "label": None, "categories": None, "bacap_code": "resident_age",
+     "populationBase": "all people"},
+    {"code": "ethnic_group_tb_3a", "label": None, "categories": None, "bacap_code": "ethnic_group",
+     "populationBase": "all people"},
+    {"code": "hh_size_3a", "label": None, "categories": None, "bacap_code": "hh_size",
+     "populationBase": "all households"}
+]
+AGE_BANDS = {
+    "resident_age_3a": [(0, 15), (16, 64), (65, None)],
+    "resident_age_18b": [(low, low + 4) for low in range(0, 85, 5)] + [(85, None)],
+    "resident_age_6a": [(0, 4), (5, 15), (16, 24), (25, 49), (50, 64), (65, None)],
+    "resident_age_4x": [(0, 9), (10, 29), (30, 69), (70, None)]
+}
+
+
+def age_band_label(low, high):
+    if low == 0:
+        return 'Aged {} years and under'.format(high)
+    if high is None:
+        return 'Aged {} years and over'.format(low)
+    return 'Aged {} to {} years'.format(low, high)
+
+
+def make_classifications():
+    """Return a map from classification code to its label, population types, categories and
+    a function that gives the category ID of a person."""
+    classifications = {
+        "sex": {
+            "label": "Sex", "poptypes": ["UR", "UR_HH"], "categories": [("1", "Female"), ("2", "Male")],
+            "category_id": lambda person: str(person["sex"])
+        },
+        "ethnic_group_tb_3a": {
+            "label": "Ethnic group", "poptypes": ["UR", "UR_HH"],
+            "categories": [("1", "Asian"), ("2", "Black"), ("3", "White")],
+            "category_id": lambda person: str(person["ethnic_group"])
+        },
+        "religion_tb_9a": {
+            "label": "Religion", "poptypes": ["UR", "UR_HH"],
+            "categories": [(str(i), "Religion {}".format(i)) for i in range(1, 10)],
+            "category_id": lambda person: str(person["religion"])
+        },
+        "hh_size_3a": {
+            "label": "Household size", "poptypes": ["UR_HH"],
+            "categories": [("-8", "Does not apply"), ("1", "1 person"), ("2", "2 or more people")],
+            "category_id": lambda person: str(person["hh_size"])
+        }
+    }
+    for code, bands in AGE_BANDS.items():
+        def category_id(person, bands=bands):
+            for i, (low, high) in enumerate(bands):
+                if low <= person["age"] and (high is None or person["age"] <= high):
+                    return str(i + 1)
+        classifications[code] = {
+            "label": "Age", "poptypes": ["UR", "UR_HH"],
+            "categories": [(str(i + 1), age_band_label(low, high)) for i, (low, high) in enumerate(bands)],
+            "category_id": category_id
+        }
+    return classifications
+
+
+def make_population(classifications):
+    """Return a fixed list of people, each with their LTLA, whether they are in a household,
+    and a map from classification code to category ID."""
+    rng = random.Random(SEED)
+    ltla_weights = [len(LTLAS) - i for i in range(len(LTLAS) - 1)] + [1]
+    population = []
+    for i in range(POPULATION_SIZE):
+        person = {
+            "sex": rng.randrange(1, 3),
+            "age": min(int(rng.expovariate(1 / 35)), 95),
+            "ethnic_group": rng.choices([1, 2, 3], [1, 1, 8])[0],
+            "religion": rng.choices(range(1, 10), [40, 30, 10, 5, 5, 4, 3, 2, 1])[0],
+            "hh_size": rng.choice([1, 2]) if rng.random() < 0.97 else None,
+            # Every LTLA has at least one person, as percentages of an empty LTLA are undefined
+            "ltla": LTLAS[i] if i < len(LTLAS) else rng.choices(LTLAS, ltla_weights)[0]
+        }
+        population.append({
+            "ltla": person["ltla"],
+            "in_household": person["hh_size"] is not None,
+            "category_ids": {
+                code: classification["category_id"](person) for code, classification in classifications.items()
+                if "UR" in classification["poptypes"] or person["hh_size"] is not None
+            }
+        })
+    return population
+
+
+def make_observations(classifications, population, codes, poptype, geography):
+    """Return the observations of a census-observations response for the classifications `codes`."""
+    if poptype == 'UR_HH':
+        population = [person for person in population if person["in_household"]]
+    counts = {}
+    for person in population:
+        area = person["ltla"] if geography == 'ltla' else 'K04000001'
+        key = (area,) + tuple(person["category_ids"][c] for c in codes)
+        counts[key] = counts.get(key, 0) + 1
+    areas = LTLAS if geography == 'ltla' else ['K04000001']
+    observations = []
+    for area in areas:
+        for categories in itertools.product(*(classifications[c]["categories"] for c in codes)):
+            dimensions = [{"dimension": "Geography", "dimension_id": geography, "option": area, "option_id": area}]
+            dimensions += [
+                {"dimension": classifications[c]["label"], "dimension_id": c, "option": label, "option_id": category_id}
+                for c, (category_id, label) in zip(codes, categories)
+            ]
+            key = (area,) + tuple(category_id for category_id, _ in categories)
+            observations.append({"dimensions": dimensions, "observation": counts.get(key, 0)})
+    return observations
+
+
+def classification_family(c):
+    return 'resident_age' if c.startswith('resident_age') else c
+
+
+def is_blocked(cc, c):
+    """Return True for the national cubes that the fixture API blocks."""
+    return len(cc) == 3 and c == 'hh_size_3a' or len(cc) == 2 and 'ethnic_group_tb_3a' in cc and c == 'resident_age_4x'
+
+
+def write_gzipped_json(filename, data):
+    # mtime=0 makes the files identical on every run
+    with open(filename, 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', mtime=0) as gz:
+            gz.write(json.dumps(data).encode('utf-8'))
+
+
+def write_json(filename, data):
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=4)
+
+
+def build(root):
+    """Write the input-txt-files and downloaded directories of the fixture under `root`, which must not exist."""
+    classifications = make_classifications()
+    population = make_population(classifications)
+    max_var_selections = 3
+
+    os.makedirs(os.path.join(root, 'input-txt-files'))
+    with open(os.path.join(root, 'input-txt-files/input-classifications.txt'), 'w') as f:
+        f.write('\n'.join(INPUT_CLASSIFICATIONS) + '\n')
+    write_json(os.path.join(root, 'input-txt-files/output-classifications-with-details.json'), OUTPUT_CLASSIFICATIONS)
+    write_json(os.path.join(root, 'input-txt-files/config.json'), {
+        "national_url_pattern": "https://example.invalid/{}/{}",
+        "ltla_url_pattern": "https://example.invalid/ltla/{}",
+        "max_var_selections": max_var_selections,
+        "bulk_max_outputs": 4,
+        "bulk_max_cells": 500000,
+        "max_concurrent_requests": 4
+    })
+
+    for d in ['downloaded', 'generated']:
+        for num_vars in range(max_var_selections + 1):
+            os.makedirs(os.path.join(root, '{}/{}var'.format(d, num_vars)))
+            os.makedirs(os.path.join(root, '{}/{}var-by-ltla'.format(d, num_vars)))
+    for poptype in ['UR', 'UR_HH']:
+        os.makedirs(os.path.join(root, 'downloaded/classifications-{}'.format(poptype)))
+        for code, classification in classifications.items():
+            if poptype not in classification["poptypes"]:
+                continue
+            write_json(os.path.join(root, 'downloaded/classifications-{}/{}.json'.format(poptype, code)), {"items": [{
+                "id": code,
+                "label": classification["label"],
+                "categories_count": len(classification["categories"]),
+                "categories": [
+                    {"id": category_id, "label": label} for category_id, label in classification["categories"]
+                ]
+            }]})
+    write_json(os.path.join(root, 'downloaded/ltla-geog.json'), {
+        "items": [{"id": ltla, "label": "Area " + ltla} for ltla in LTLAS]
+    })
+
+    for num_vars in range(max_var_selections + 1):
+        for cc in itertools.combinations(INPUT_CLASSIFICATIONS, num_vars):
+            cc = list(cc)
+            if len({classification_family(c) for c in cc}) < num_vars:
+                continue
+            if num_vars > 0:
+                write_gzipped_json(os.path.join(root, 'downloaded/{}var/{}.json.gz'.format(num_vars, '-'.join(cc))), {
+                    "observations": make_observations(classifications, population, cc, 'UR', 'nat'),
+                    "blocked_areas": 0, "total_areas": 1
+                })
+                if num_vars == 3:
+                    ltla_data = {"observations": None, "blocked_areas": 331, "total_areas": 331}
+                else:
+                    observations = make_observations(classifications, population, cc, 'UR', 'ltla')
+                    blocked_areas = 0
+                    if num_vars == 2:
+                        observations = [
+                            obs for obs in observations if obs["dimensions"][0]["option_id"] != BLOCKED_LTLA
+                        ]
+                        blocked_areas = 1
+                    ltla_data = {"observations": observations, "blocked_areas": blocked_areas, "total_areas": 331}
+                write_gzipped_json(
+                    os.path.join(root, 'downloaded/{}var-by-ltla/{}_by_geog.json.gz'.format(num_vars, '-'.join(cc))),
+                    ltla_data
+                )
+            for output in OUTPUT_CLASSIFICATIONS:
+                c = output["code"]
+                if classification_family(c) in [classification_family(c_) for c_ in cc]:
+                    continue
+                poptype = 'UR_HH' if c.startswith('hh_') else 'UR'
+                if is_blocked(cc, c):
+                    data = {"observations": None, "blocked_areas": 1, "total_areas": 1}
+                else:
+                    data = {
+                        "observations": make_observations(classifications, population, cc + [c], poptype, 'nat'),
+                        "blocked_areas": 0, "total_areas": 1
+                    }
+                write_gzipped_json(
+                    os.path.join(root, 'downloaded/{}var/{}.json.gz'.format(num_vars, '-'.join(cc + [c]))), data
+                )
+
+
+if __name__ == "__main__":
+    build(sys.argv[1])
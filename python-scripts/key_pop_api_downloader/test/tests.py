@@ -1,6 +1,13 @@
 import key_pop_api_downloader as pgp
+from key_pop_api_downloader import cube_format, metadata, validation
+from key_pop_api_downloader.throttle import AdaptiveThrottle, parse_rate_limit_reset, parse_retry_after, percentile
 import unittest
 import math
+import gzip
+import json
+import lzma
+import os
+import tempfile
 
 
 class Tests(unittest.TestCase):
@@ -40,6 +47,39 @@ class Tests(unittest.TestCase):
         combos3 = pgp.get_input_classification_combinations(classifications, 3)
         self.assertEqual(len(combos3), 0)
 
+    def test_build_combination_index(self):
+        index = pgp.build_combination_index(
+            ['resident_age_3a', 'resident_age_8d', 'sex'],
+            ['hh_size_5a', 'resident_age_18b', 'sex'],
+            2,
+            {'hh_size_5a': True, 'resident_age_18b': False, 'sex': False}
+        )
+        self.assertEqual(index['families'], {'resident_age': 0, 'sex': 1, 'hh_size': 2})
+        self.assertEqual([len(level) for level in index['levels']], [1, 3, 2])
+        entry = index['levels'][2][0]
+        self.assertEqual(entry['cc'], ['resident_age_3a', 'sex'])
+        self.assertEqual(entry['family_ids'], [0, 1])
+        self.assertEqual(entry['total_path'], 'downloaded/2var/resident_age_3a-sex.json.gz')
+        self.assertEqual(entry['ltla_path'], 'downloaded/2var-by-ltla/resident_age_3a-sex_by_geog.json.gz')
+        self.assertEqual(entry['outputs'], [
+            {
+                'c': 'hh_size_5a',
+                'path': 'downloaded/2var/resident_age_3a-sex-hh_size_5a.json.gz',
+                'poptype': 'UR_HH',
+                'download': True
+            },
+            {
+                'c': 'resident_age_18b',
+                'path': 'downloaded/1var/sex-resident_age_18b.json.gz',
+                'poptype': 'UR',
+                'download': False
+            }
+        ])
+        self.assertEqual(index['levels'][0][0]['total_path'], None)
+        self.assertEqual(
+            [o['c'] for o in index['levels'][0][0]['outputs']], ['hh_size_5a', 'resident_age_18b', 'sex']
+        )
+
     def rough_round(self, numerator, denominator, digits):
         z = (numerator / denominator) * 10 ** digits
         return math.floor(z + 0.500000001) / 10 ** digits
@@ -107,6 +147,676 @@ class Tests(unittest.TestCase):
                 '_by_geog.json'
             )
 
+    def test_write_json_file_dedup_hardlink(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = pgp.new_dedup_store('hardlink', os.path.join(tmp, 'blobs'))
+            paths = [os.path.join(tmp, name) for name in ['a.json', 'b.json', 'c.json']]
+            pgp.write_json_file(paths[0], {"sex": "blocked"}, store)
+            pgp.write_json_file(paths[1], {"sex": "blocked"}, store)
+            pgp.write_json_file(paths[2], {"sex": "all_zero"}, store)
+            self.assertEqual(os.stat(paths[0]).st_ino, os.stat(paths[1]).st_ino)
+            self.assertNotEqual(os.stat(paths[0]).st_ino, os.stat(paths[2]).st_ino)
+            self.assertEqual(store["unique_files"], 2)
+            self.assertEqual(store["duplicate_files"], 1)
+            self.assertEqual(store["bytes_saved"], len('{"sex": "blocked"}'))
+            self.assertEqual(store["manifest"][paths[0]], store["manifest"][paths[1]])
+
+            # Writing without deduplication must not modify the shared blob
+            pgp.write_json_file(paths[1], {"sex": "all_zero"})
+            with open(paths[0], 'r') as f:
+                self.assertEqual(f.read(), '{"sex": "blocked"}')
+
+    def test_write_json_file_dedup_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = pgp.new_dedup_store('manifest', os.path.join(tmp, 'blobs'))
+            # A file left by a run without deduplication is removed
+            pgp.write_json_file(os.path.join(tmp, 'a.json'), [3])
+            pgp.write_json_file(os.path.join(tmp, 'a.json'), [1, 2], store)
+            pgp.write_json_file(os.path.join(tmp, 'b.json'), [1, 2], store)
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'a.json')))
+            self.assertEqual(len(os.listdir(os.path.join(tmp, 'blobs'))), 1)
+            self.assertEqual(len(store["manifest"]), 2)
+        with self.assertRaises(ValueError):
+            pgp.new_dedup_store('symlink')
+
+    def test_dedup_rerun_counts_and_pruning(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            blob_directory = os.path.join(tmp, 'blobs')
+            manifest_filename = os.path.join(tmp, 'dedup-manifest.json')
+            paths = [os.path.join(tmp, name) for name in ['a.json', 'b.json']]
+            store = pgp.new_dedup_store('hardlink', blob_directory)
+            pgp.write_json_file(paths[0], [1], store)
+            pgp.write_json_file(paths[1], [2], store)
+            self.assertEqual(pgp.save_dedup_manifest(store, manifest_filename), 0)
+
+            # The blobs from the first run don't count as duplicates in a re-run
+            store = pgp.new_dedup_store('hardlink', blob_directory)
+            pgp.write_json_file(paths[0], [1], store)
+            pgp.write_json_file(paths[1], [1], store)
+            self.assertEqual((store["unique_files"], store["duplicate_files"]), (1, 1))
+            # The blob of [2] is no longer used
+            self.assertEqual(pgp.save_dedup_manifest(store, manifest_filename), 1)
+            self.assertEqual(os.listdir(blob_directory), [store["manifest"][paths[0]] + '.json'])
+
+            # A path written again without deduplication is dropped from the manifest, with its blob
+            pgp.write_json_file(paths[1], [4])
+            store = pgp.new_dedup_store('hardlink', blob_directory)
+            pgp.write_json_file(paths[0], [5], store)
+            self.assertEqual(pgp.save_dedup_manifest(store, manifest_filename), 1)
+            with open(manifest_filename, 'r') as f:
+                self.assertEqual(list(json.load(f)["files"]), [paths[0]])
+
+            merged = pgp.new_dedup_store('hardlink', blob_directory)
+            for path, data in [(paths[0], [1]), (paths[1], [3])]:
+                other = pgp.new_dedup_store('hardlink', blob_directory)
+                pgp.write_json_file(path, data, other)
+                pgp.merge_dedup_stores(merged, other)
+            other = pgp.new_dedup_store('hardlink', blob_directory)
+            pgp.write_json_file(os.path.join(tmp, 'c.json'), [3], other)
+            pgp.merge_dedup_stores(merged, other)
+            self.assertEqual((merged["unique_files"], merged["duplicate_files"]), (2, 1))
+            self.assertEqual(merged["bytes_saved"], len('[3]'))
+
+    def test_build_file_manifest(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, '1var_percent'))
+            with open(os.path.join(tmp, '1var_percent', 'sex.json'), 'w') as f:
+                f.write('{}')
+            os.link(os.path.join(tmp, '1var_percent', 'sex.json'), os.path.join(tmp, 'copy.json'))
+            manifest = pgp.build_file_manifest(tmp, processes=1)
+            self.assertEqual(sorted(manifest), ['1var_percent/sex.json', 'copy.json'])
+            self.assertEqual(manifest['copy.json'], pgp.hash_file(os.path.join(tmp, 'copy.json')))
+            self.assertEqual(manifest, pgp.build_file_manifest(tmp, processes=2))
+            os.makedirs(os.path.join(tmp, 'blobs'))
+            os.link(os.path.join(tmp, 'copy.json'), os.path.join(tmp, 'blobs', 'abc.json'))
+            self.assertEqual(manifest, pgp.build_file_manifest(tmp, processes=1, exclude=['blobs']))
+
+    def test_publish_delta_blob_only_files(self):
+        publish_delta = pgp.load_script('publish-delta.py')
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            self.addCleanup(os.chdir, cwd)
+            os.makedirs('generated/1var-combined_percent')
+            store = pgp.new_dedup_store('manifest')
+            pgp.write_json_file('generated/1var-combined_percent//sex.json', {'a': 1}, store)
+            pgp.write_json_file('generated/1var-combined_percent//age.json', {'a': 2}, store)
+            pgp.save_dedup_manifest(store)
+            with open('generated/1var-combined_percent/age.json', 'w') as f:
+                f.write('{}')
+            blob_path = os.path.join('generated/blobs', store["manifest"]['generated/1var-combined_percent//sex.json'])
+            self.assertEqual(
+                publish_delta.blob_only_files('generated'), {'1var-combined_percent/sex.json': blob_path + '.json'}
+            )
+            os.remove(blob_path + '.json')
+            with self.assertRaises(FileNotFoundError):
+                publish_delta.blob_only_files('generated')
+
+    def test_diff_file_manifests(self):
+        self.assertEqual(
+            pgp.diff_file_manifests({'a': '1', 'b': '2', 'c': '3'}, {'b': '2', 'c': '4', 'd': '5'}),
+            {'added': ['d'], 'changed': ['c'], 'removed': ['a']}
+        )
+
+    def test_bundle_output_classifications(self):
+        category_counts = {'sex': 2, 'a': 10, 'b': 10, 'c': 3, 'd': 100}
+        families = {c: c for c in category_counts}
+        self.assertEqual(
+            pgp.bundle_output_classifications(['sex'], ['a', 'b', 'c', 'd'], category_counts, families, 2, 1000),
+            [['a', 'b'], ['c', 'd']]
+        )
+        self.assertEqual(
+            pgp.bundle_output_classifications(['sex'], ['a', 'b', 'c', 'd'], category_counts, families, 4, 600),
+            [['a', 'b', 'c'], ['d']]
+        )
+        self.assertEqual(
+            pgp.bundle_output_classifications([], ['d'], category_counts, families, 4, 10),
+            [['d']]
+        )
+
+    def test_bundle_output_classifications_families(self):
+        codes = ['sex', 'resident_age_18b', 'resident_age_23a', 'religion_tb_9a', 'ethnic_group_tb_3a', 'hh_size_3a']
+        category_counts = {c: 5 for c in codes}
+        families = {c: pgp.remove_classification_number(c) for c in codes}
+        self.assertEqual(
+            pgp.bundle_output_classifications(
+                ['sex'], ['resident_age_18b', 'resident_age_23a', 'religion_tb_9a'], category_counts, families,
+                4, 10 ** 6
+            ),
+            [['resident_age_18b'], ['resident_age_23a', 'religion_tb_9a']]
+        )
+        # Outputs of the same family as an input are never bundled with other outputs
+        self.assertEqual(
+            pgp.bundle_output_classifications(
+                ['ethnic_group_tb_3a'], ['sex', 'ethnic_group_tb_3a', 'hh_size_3a'], category_counts, families, 4,
+                10 ** 6
+            ),
+            [['sex'], ['ethnic_group_tb_3a'], ['hh_size_3a']]
+        )
+
+    def test_get_bundle_checks_totals(self):
+        get_data = pgp.load_script('get-data.py')
+
+        def observation(sex, age, count):
+            return {"dimensions": [
+                {"dimension_id": "nat", "option_id": "K04000001"},
+                {"dimension_id": "sex", "option_id": sex},
+                {"dimension_id": "resident_age_3a", "option_id": age}
+            ], "observation": count}
+
+        class FakeThrottle:
+            def fetch(self, url, get):
+                return json.dumps({"observations": [
+                    observation("1", "1", 100), observation("1", "2", 100),
+                    observation("2", "1", 300), observation("2", "2", 0)
+                ], "blocked_areas": 0, "total_areas": 1}).encode('utf-8')
+
+        def total_data(female, male):
+            return {"observations": [
+                {"dimensions": [{"dimension_id": "sex", "option_id": "1"}], "observation": female},
+                {"dimensions": [{"dimension_id": "sex", "option_id": "2"}], "observation": male}
+            ], "blocked_areas": 0, "total_areas": 1}
+
+        with tempfile.TemporaryDirectory() as tmp:
+            combination = {"cc": ["sex"], "total_path": os.path.join(tmp, 'sex.json.gz')}
+            bundle = [{"c": "resident_age_3a", "path": os.path.join(tmp, 'sex-resident_age_3a.json.gz')}]
+            config = {
+                "url_pattern": "https://example.invalid/{}/{}", "throttle": FakeThrottle(),
+                "request_timeout": 300, "compact": False, "keep_json": False, "download_cache": None
+            }
+            # Female counts sum to 200, far from the total of 900
+            self.assertFalse(get_data.get_bundle(combination, bundle, 'UR', total_data(900, 300), config))
+            self.assertFalse(os.path.exists(bundle[0]["path"]))
+            self.assertTrue(get_data.get_bundle(combination, bundle, 'UR', total_data(203, 298), config))
+            self.assertEqual(pgp.read_json_gz(bundle[0]["path"])["observations"][0]["observation"], 100)
+
+            # An error page rather than JSON
+            config["throttle"].fetch = lambda url, get: b'<html>Bad Request</html>'
+            os.remove(bundle[0]["path"])
+            self.assertFalse(get_data.get_bundle(combination, bundle, 'UR', total_data(203, 298), config))
+            self.assertFalse(os.path.exists(bundle[0]["path"]))
+
+    def test_marginalise_response(self):
+        def dims(sex, age):
+            return [
+                {"dimension_id": "nat", "option_id": "K04000001"},
+                {"dimension_id": "sex", "option_id": sex},
+                {"dimension_id": "resident_age_3a", "option_id": age}
+            ]
+        data = {
+            "observations": [
+                {"dimensions": dims(sex, age), "observation": int(sex) * 10 + int(age)}
+                for sex in ["1", "2"] for age in ["1", "2", "3"]
+            ],
+            "total_observations": 6,
+            "blocked_areas": 0
+        }
+        result = pgp.marginalise_response(data, ['nat', 'sex'])
+        self.assertEqual(result["blocked_areas"], 0)
+        self.assertEqual(result["total_observations"], 2)
+        self.assertEqual(
+            [[dim["option_id"] for dim in obs["dimensions"]] + [obs["observation"]] for obs in result["observations"]],
+            [["K04000001", "1", 36], ["K04000001", "2", 66]]
+        )
+        self.assertEqual(len(data["observations"]), 6)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after('120'), 120)
+        self.assertEqual(parse_retry_after(None), None)
+        self.assertEqual(parse_retry_after('soon'), None)
+        self.assertEqual(parse_retry_after('Wed, 21 Oct 2015 07:28:30 GMT', now=1445412480), 30)
+        self.assertEqual(parse_rate_limit_reset('30', now=1445412480), 30)
+        self.assertEqual(parse_rate_limit_reset('1445412510', now=1445412480), 30)
+        self.assertEqual(parse_rate_limit_reset('1445412470', now=1445412480), 0)
+        self.assertEqual(parse_rate_limit_reset(None), None)
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 50), None)
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 50), 3)
+        self.assertEqual(percentile(list(range(1, 101)), 95), 95)
+
+    def test_adaptive_throttle(self):
+        throttle = AdaptiveThrottle(max_concurrency=3, initial_delay=0, min_delay=0, report_every=1000)
+        for _ in range(10):
+            throttle.acquire()
+            throttle.release(0.1, 200)
+        self.assertEqual(throttle.concurrency, 3)
+        throttle.acquire()
+        throttle.release(0.1, 429, {'retry-after': '0'})
+        self.assertEqual(throttle.concurrency, 1)
+        metrics = throttle.metrics()
+        self.assertEqual(metrics["requests"], 11)
+        self.assertEqual(metrics["errors"], 1)
+        self.assertAlmostEqual(metrics["error_rate"], 1 / 11)
+        self.assertEqual(metrics["latency_p95"], 0.1)
+
+    def test_adaptive_throttle_fetch(self):
+        class Response:
+            def __init__(self, status_code, content):
+                self.status_code = status_code
+                self.content = content
+                self.headers = {'Retry-After': '0'}
+
+        responses = [ConnectionError(), Response(503, b''), Response(200, b'{}'), Response(500, b'')]
+
+        def get(url):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        throttle = AdaptiveThrottle(initial_delay=0, min_delay=0, max_delay=0)
+        self.assertEqual(throttle.fetch('https://example.com', get), b'{}')
+        self.assertEqual(throttle.metrics()["errors"], 2)
+        with self.assertRaises(IOError):
+            throttle.fetch('https://example.com', get, max_attempts=1)
+        # Other exceptions are raised, but the request's slot is still released, and they aren't API errors
+        responses.append(ValueError())
+        with self.assertRaises(ValueError):
+            throttle.fetch('https://example.com', get)
+        self.assertEqual(throttle.in_flight, 0)
+        self.assertEqual(throttle.metrics()["errors"], 3)
+
+    def test_cube_format_round_trip(self):
+        data = {
+            "observations": [
+                {
+                    "dimensions": [
+                        {"dimension": "Sex", "dimension_id": "sex", "option": label, "option_id": option_id},
+                        {"dimension": "Age", "dimension_id": "resident_age_3a", "option": "", "option_id": age}
+                    ],
+                    "observation": count
+                }
+                for (option_id, label), age, count in [
+                    (("1", "Female"), "1", 0), (("1", "Female"), "2", 70000), (("2", "Male"), "2", 12)
+                ]
+            ],
+            "blocked_areas": 0,
+            "total_observations": 3
+        }
+        self.assertEqual(cube_format.decode_response(cube_format.encode_response(data)), data)
+        blocked = {"observations": None, "blocked_areas": 331, "total_observations": 0}
+        self.assertEqual(cube_format.decode_response(cube_format.encode_response(blocked)), blocked)
+
+    def test_cube_format_coo(self):
+        observations = [
+            {'dimensions': [{'dimension_id': 'ltla', 'option_id': ltla}, {'dimension_id': 'sex', 'option_id': sex}],
+             'observation': count}
+            for ltla, sex, count in [('E1', '1', 0), ('E1', '2', 0), ('E2', '1', 0), ('E2', '2', 300), ('E3', '1', 0)]
+        ]
+        # E3 has a missing cell, which must stay missing rather than becoming zero
+        data = {'observations': observations, 'blocked_areas': 1}
+        payload = cube_format.encode_response(data)
+        self.assertEqual(cube_format.decode_response(payload), data)
+        self.assertEqual(cube_format.decode_response(cube_format.encode_response(data, 'dense')), data)
+        self.assertEqual(json.loads(lzma.decompress(payload).split(b'\n')[0])['encoding'], 'coo')
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'a.cube.xz')
+            with open(filename, 'wb') as f:
+                f.write(payload)
+            self.assertEqual(list(cube_format.iter_compact_observations(filename, skip_zeros=True)), [observations[3]])
+
+    def test_cube_format_smallest_typecode(self):
+        self.assertEqual(cube_format.smallest_typecode([-1, 127]), 'b')
+        self.assertEqual(cube_format.smallest_typecode([128]), 'h')
+        self.assertEqual(cube_format.smallest_typecode([60000000]), 'i')
+
+    def test_save_download_compact(self):
+        data = {"observations": None, "blocked_areas": 1}
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'sex.json.gz')
+            pgp.save_download(path, json.dumps(data).encode('utf-8'))
+            self.assertTrue(os.path.isfile(path))
+            pgp.save_download(path, json.dumps(data).encode('utf-8'), compact=True)
+            self.assertFalse(os.path.isfile(path))
+            self.assertTrue(os.path.isfile(os.path.join(tmp, 'sex.cube.xz')))
+            self.assertTrue(pgp.download_exists(path))
+            self.assertEqual(pgp.read_json_gz(path), data)
+            pgp.save_download(path, json.dumps(data).encode('utf-8'), compact=True, keep_json=True)
+            with gzip.open(path, 'r') as f:
+                self.assertEqual(json.loads(f.read().decode('utf-8')), data)
+
+    def write_metadata_sources(self):
+        os.makedirs('generated')
+        os.makedirs('input-txt-files')
+        os.makedirs('downloaded')
+        with open('generated/all-classifications.json', 'w') as f:
+            json.dump({
+                'sex': {'poptypes': ['UR', 'UR_HH'], 'categories': [{'id': '1', 'label': 'Female'}]},
+                'hh_size_5a': {'poptypes': ['UR_HH'], 'categories': [{'id': '1', 'label': '1 person'}]}
+            }, f)
+        with open('input-txt-files/input-classifications.txt', 'w') as f:
+            f.write('sex\n')
+        with open('input-txt-files/output-classifications-with-details.json', 'w') as f:
+            json.dump([{'code': 'hh_size_5a', 'categories': None}, {'code': 'sex', 'categories': None}], f)
+        with open('input-txt-files/config.json', 'w') as f:
+            json.dump({'max_var_selections': 1}, f)
+
+    def test_metadata(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            self.addCleanup(os.chdir, cwd)
+            self.addCleanup(metadata.reset)
+            self.write_metadata_sources()
+            metadata.reset()
+            self.assertEqual(metadata.input_and_output_classification_codes(), (['sex'], ['hh_size_5a', 'sex']))
+            self.assertTrue(metadata.is_household_var('hh_size_5a'))
+            self.assertFalse(metadata.is_household_var('sex'))
+            self.assertEqual(metadata.classification_family('hh_size_5a'), 'hh_size')
+            self.assertEqual(metadata.all_classifications()['sex']['categories_map'], {'1': 'Female'})
+            self.assertEqual(
+                metadata.output_classification_details()['sex']['categories'], [{'label': 'Female', 'cells': [1]}]
+            )
+            self.assertEqual([entry['cc'] for entry in metadata.combinations(1)], [['sex']])
+
+            # The snapshot is still current if a source file is rewritten with the same contents...
+            self.assertIsNotNone(metadata.load_snapshot(metadata.SNAPSHOT_FILENAME))
+            with open('input-txt-files/input-classifications.txt', 'w') as f:
+                f.write('sex\n')
+            os.utime('input-txt-files/input-classifications.txt', (0, 0))
+            self.assertIsNotNone(metadata.load_snapshot(metadata.SNAPSHOT_FILENAME))
+            # ...but not if its contents change
+            with open('input-txt-files/input-classifications.txt', 'w') as f:
+                f.write('hh_size_5a\nsex\n')
+            self.assertIsNone(metadata.load_snapshot(metadata.SNAPSHOT_FILENAME))
+
+    def write_ltla_response(self, filename, counts):
+        observations = [
+            {
+                'dimensions': [
+                    {'dimension_id': 'ltla', 'option_id': ltla},
+                    {'dimension_id': 'sex', 'option_id': sex},
+                    {'dimension_id': 'hh_size_5a', 'option_id': hh_size}
+                ],
+                'observation': count
+            }
+            for (ltla, sex, hh_size), count in counts.items()
+        ]
+        with gzip.open(filename, 'wb') as f:
+            f.write(json.dumps({'observations': observations, 'blocked_areas': 1, 'total_areas': 3}).encode('utf-8'))
+
+    def test_iter_observations(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            filename = os.path.join(tmp, 'a.json.gz')
+            self.write_ltla_response(filename, {('E1', '1', '1'): 12345, ('E2', '2', '1'): 0})
+            expected = pgp.read_json_gz(filename)['observations']
+            self.assertEqual(list(pgp.iter_observations(filename)), expected)
+            # Read in tiny chunks, so that values span chunk boundaries
+            with gzip.open(filename, 'rt', encoding='utf-8') as f:
+                reader = pgp._JsonStreamReader(f, chunk_size=3)
+                self.assertEqual(list(pgp._iter_json_observations(reader)), expected)
+            pgp.save_download(filename, json.dumps({'observations': expected}).encode('utf-8'), compact=True)
+            self.assertEqual(list(pgp.iter_observations(filename)), expected)
+            pgp.save_download(filename, b'{"blocked_areas": 331, "observations": null}')
+            self.assertEqual(list(pgp.iter_observations(filename)), [])
+
+    def test_generate_by_ltla_chunked(self):
+        generate_files_by_ltla = pgp.load_script('generate-files-by-ltla.py')
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            self.addCleanup(os.chdir, cwd)
+            self.addCleanup(metadata.reset)
+            self.write_metadata_sources()
+            with open('generated/all-classifications.json', 'w') as f:
+                json.dump({
+                    'sex': {'poptypes': ['UR', 'UR_HH'], 'categories': [
+                        {'id': '1', 'label': 'Female'}, {'id': '2', 'label': 'Male'}
+                    ]},
+                    'hh_size_5a': {'poptypes': ['UR_HH'], 'categories': [
+                        {'id': '1', 'label': '1 person'}, {'id': '2', 'label': '2 people'},
+                        {'id': '3', 'label': '3 or more people'}
+                    ]}
+                }, f)
+            with open('input-txt-files/input-classifications.txt', 'w') as f:
+                f.write('hh_size_5a\nsex\n')
+            with open('input-txt-files/config.json', 'w') as f:
+                json.dump({'max_var_selections': 2}, f)
+            with open('downloaded/ltla-geog.json', 'w') as f:
+                json.dump({'items': [{'id': 'E1'}, {'id': 'E2'}, {'id': 'W1'}]}, f)
+            os.makedirs('downloaded/2var-by-ltla')
+            # W1 is missing, as it is when the API blocks an area
+            counts = {
+                (ltla, sex, hh_size): 3 * i + j * 7 + 1
+                for i, ltla in enumerate(['E2', 'E1'])
+                for j, (sex, hh_size) in enumerate([(s, h) for s in '12' for h in '123'])
+            }
+            self.write_ltla_response('downloaded/2var-by-ltla/hh_size_5a-sex_by_geog.json.gz', counts)
+            metadata.reset()
+            combination = metadata.combinations(2)[0]
+            self.assertEqual(combination['cc'], ['hh_size_5a', 'sex'])
+
+            outputs = {}
+            for memory_ceiling_mb in [None, 0]:
+                memory_report = []
+                generate_files_by_ltla.generate_combination_files(
+                    2, 0, combination, memory_ceiling_mb=memory_ceiling_mb, memory_report=memory_report
+                )
+                self.assertEqual(memory_report[0]['mode'], 'lookup' if memory_ceiling_mb is None else 'chunked')
+                self.assertEqual(memory_report[0]['cells'], 18)
+                self.assertEqual(memory_report[0]['entries'], 12)
+                # With no memory to spare, the response is read once for each hh_size_5a category
+                self.assertEqual(memory_report[0]['passes'], 1 if memory_ceiling_mb is None else 3)
+                self.assertIn('rss_delta_mb', memory_report[0])
+                outputs[memory_ceiling_mb] = {}
+                for path in pgp.walk_files('generated/2var-by-ltla_percent'):
+                    with open(path, 'rb') as f:
+                        outputs[memory_ceiling_mb][path] = f.read()
+            self.assertEqual(len(outputs[0]), 3)
+            self.assertEqual(outputs[None], outputs[0])
+            data = json.loads(outputs[0]['generated/2var-by-ltla_percent/hh_size_5a-2/sex_by_geog.json'])
+            self.assertEqual(sorted(data['1']), ['E1', 'E2'])
+            self.assertEqual(data['1']['E1'], [11, pgp.round_fraction(100 * 11, sum(range(4, 40, 7)), 1)])
+
+            # The arrays map data format has an element for each LTLA, in the order of metadata.ltlas()
+            for memory_ceiling_mb in [None, 0]:
+                generate_files_by_ltla.generate_combination_files(
+                    2, 0, combination, memory_ceiling_mb=memory_ceiling_mb, map_data_format='arrays'
+                )
+                with open('generated/2var-by-ltla_percent/hh_size_5a-2/sex_by_geog.json', 'r') as f:
+                    arrays_data = json.load(f)
+                self.assertEqual(sorted(arrays_data), ['1', '2'])
+                self.assertEqual(arrays_data['1'], {
+                    'count': [data['1']['E1'][0], data['1']['E2'][0], None],
+                    'percent': [data['1']['E1'][1], data['1']['E2'][1], None]
+                })
+            self.assertEqual(
+                generate_files_by_ltla.dataset_to_arrays({}), {'count': [None] * 3, 'percent': [None] * 3}
+            )
+
+    def test_metadata_household_var_check(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            self.addCleanup(os.chdir, cwd)
+            self.write_metadata_sources()
+            with open('input-txt-files/output-classifications-with-details.json', 'w') as f:
+                json.dump([{'code': 'hh_size_5a', 'categories': None}], f)
+            with open('generated/all-classifications.json', 'w') as f:
+                json.dump({
+                    'sex': {'poptypes': ['UR', 'UR_HH'], 'categories': []},
+                    'hh_size_5a': {'poptypes': ['UR', 'UR_HH'], 'categories': []}
+                }, f)
+            with self.assertRaises(Exception):
+                metadata.build_metadata()
+
+    def test_combine_json_files(self):
+        bar_chart_data = {'1': {'sex': {'count': [1, 2], 'percent': [33.3, 66.7]}}}
+        map_data = {'1': {'E06000001': [3, 12.5]}}
+        with tempfile.TemporaryDirectory() as tmp:
+            pair = tuple(os.path.join(tmp, name) for name in ['bar.json', 'map.json', 'out/combined.json'])
+            pgp.write_json_file(pair[0], bar_chart_data)
+            pgp.write_json_file(pair[1], map_data)
+            self.assertEqual(pgp.combine_json_files(pair), (True, None))
+            with open(pair[2], 'rb') as f:
+                self.assertEqual(
+                    f.read(), json.dumps({'bar_chart_data': bar_chart_data, 'map_data': map_data}).encode('utf-8')
+                )
+            # The output is newer than both inputs, so it is skipped unless forced
+            future = os.stat(pair[2]).st_mtime_ns + 10 ** 10
+            os.utime(pair[2], ns=(future, future))
+            self.assertEqual(pgp.combine_json_files(pair), (False, None))
+            written, dedup_store = pgp.combine_json_files(pair, 'manifest', os.path.join(tmp, 'blobs'), force=True)
+            self.assertTrue(written)
+            self.assertEqual(dedup_store['unique_files'], 1)
+            self.assertEqual(list(dedup_store['manifest']), [pair[2]])
+
+    def test_sparse_lookup(self):
+        generate_files = pgp.load_script('generate-files.py')
+        data = {'blocked_areas': 0, 'observations': [
+            {'dimensions': [{'dimension_id': 'nat', 'option_id': 'K1'}, {'dimension_id': 'sex', 'option_id': sex}],
+             'observation': count}
+            for sex, count in [('1', 0), ('2', 5)]
+        ]}
+        dense = generate_files.data_to_lookup(data)
+        sparse = generate_files.data_to_lookup(data, sparse=True)
+        self.assertEqual(len(sparse), len(dense) - 1)
+        self.assertEqual(sparse['total_of_counts'], dense['total_of_counts'])
+        for key in [frozenset([('sex', '1')]), frozenset([('sex', '2')])]:
+            self.assertEqual(generate_files.lookup_count(sparse, key), generate_files.lookup_count(dense, key))
+        with self.assertRaises(KeyError):
+            generate_files.lookup_count(dense, frozenset([('sex', '3')]))
+
+    def test_validation_compare_marginals(self):
+        data = {
+            "observations": [
+                {
+                    "dimensions": [
+                        {"dimension_id": "sex", "option_id": sex}, {"dimension_id": "hh_size_5a", "option_id": hh}
+                    ],
+                    "observation": count
+                }
+                for sex, hh, count in [("1", "1", 10), ("1", "2", 20), ("2", "1", 30), ("2", "2", 40)]
+            ],
+            "blocked_areas": 0
+        }
+        marginals = validation.marginal_counts(data, ["sex"])
+        self.assertEqual(marginals, {("1",): [30, 2], ("2",): [70, 2]})
+        tolerance = {"per_cell": 1, "relative": 0}
+        self.assertIsNone(validation.compare_marginals(marginals, {("1",): [33, 1], ("2",): [70, 1]}, tolerance))
+        self.assertIsNotNone(validation.compare_marginals(marginals, {("1",): [34, 1], ("2",): [70, 1]}, tolerance))
+        self.assertIsNotNone(validation.compare_marginals(marginals, {("1",): [30, 1]}, tolerance))
+
+    def test_validation_manifest(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            self.addCleanup(os.chdir, cwd)
+            self.addCleanup(metadata.reset)
+            self.write_metadata_sources()
+            metadata.reset()
+            with open('downloaded/ltla-geog.json', 'w') as f:
+                json.dump({'items': [{'id': 'E1'}, {'id': 'E2'}]}, f)
+            for dirname in ['downloaded/1var', 'downloaded/1var-by-ltla']:
+                os.makedirs(dirname)
+
+            def response(ltla_counts, geography='nat'):
+                return json.dumps({'observations': [
+                    {'dimensions': [{'dimension_id': geography, 'option_id': ltla},
+                                    {'dimension_id': 'sex', 'option_id': '1'}], 'observation': count}
+                    for ltla, count in ltla_counts
+                ], 'blocked_areas': 0}).encode('utf-8')
+            pgp.save_download('downloaded/1var/sex.json.gz', response([('K04000001', 100)]))
+            ltla_path = 'downloaded/1var-by-ltla/sex_by_geog.json.gz'
+            pgp.save_download(ltla_path, response([('E1', 60), ('E2', 140)], 'ltla'))
+            with open('downloaded/1var/sex-hh_size_5a.json.gz', 'wb') as f:
+                f.write(b'truncated')
+
+            task = (1, 0, validation.DEFAULT_TOLERANCE, True, False)
+            checked, problems = validation.validate_combination(task)
+            self.assertEqual(sorted(checked), [
+                'downloaded/1var-by-ltla/sex_by_geog.json.gz', 'downloaded/1var/sex-hh_size_5a.json.gz',
+                'downloaded/1var/sex.json.gz'
+            ])
+            self.assertEqual(sorted(problems), [ltla_path, 'downloaded/1var/sex-hh_size_5a.json.gz'])
+            manifest = validation.load_manifest()
+            validation.update_manifest(manifest, checked, problems)
+            validation.save_manifest(manifest)
+
+            # Invalid files are downloaded again even with --skip-existing
+            config = {'skip_existing_files': True, 'invalid_files': validation.invalid_files()}
+            self.assertTrue(pgp.is_skipped_download('downloaded/1var/sex.json.gz', config))
+            self.assertFalse(pgp.is_skipped_download('downloaded/1var/sex-hh_size_5a.json.gz', config))
+
+            # Once they are fixed, they are removed from the manifest
+            pgp.save_download(ltla_path, response([('E1', 60), ('E2', 40)], 'ltla'))
+            pgp.save_download('downloaded/1var/sex-hh_size_5a.json.gz', json.dumps({
+                'observations': [{'dimensions': [{'dimension_id': 'sex', 'option_id': '1'},
+                                                 {'dimension_id': 'hh_size_5a', 'option_id': '1'}],
+                                  'observation': 40}],
+                'blocked_areas': 0
+            }).encode('utf-8'))
+            checked, problems = validation.validate_combination(task)
+            self.assertEqual(problems, {})
+            validation.update_manifest(manifest, checked, problems)
+            self.assertEqual(manifest, {'files': {}})
+
+    def test_pipeline_download_cache(self):
+        run_pipeline = pgp.load_script('run-pipeline.py')
+        with tempfile.TemporaryDirectory() as tmp:
+            on_disk = os.path.join(tmp, 'on-disk.json.gz')
+            with gzip.open(on_disk, 'wb') as f:
+                f.write(b'{"a": 0}')
+            cache = run_pipeline.DownloadCache({'x': 2, 'too-big': 1, on_disk: 1}, max_bytes=10)
+            cache.put('x', b'{"a": 1}')
+            cache.put('too-big', b'{"a": 12345}')
+            cache.put('unread', b'{"a": 2}')
+            self.assertEqual(set(cache.responses), {'x'})
+            self.assertEqual(cache.read('x'), {'a': 1})
+            self.assertEqual(cache.read('x'), {'a': 1})
+            # The response is dropped after its last read
+            self.assertEqual(cache.responses, {})
+            self.assertEqual(cache.total_bytes, 0)
+            # Responses that weren't cached are read from disk
+            self.assertEqual(cache.read(on_disk), {'a': 0})
+
+    def test_validation_reads_dedup_manifest_blobs(self):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            self.addCleanup(os.chdir, cwd)
+            self.addCleanup(setattr, validation, '_dedup_blob_paths', None)
+            validation._dedup_blob_paths = None
+            os.makedirs('generated/1var_percent')
+            store = pgp.new_dedup_store('manifest')
+            pgp.write_json_file('generated/1var-combined_percent//sex.json', {'a': 1}, store)
+            pgp.save_dedup_manifest(store)
+            with open('generated/1var_percent/sex.json', 'w') as f:
+                f.write('{}')
+            location = validation.generated_file_location('generated/1var-combined_percent/sex.json')
+            self.assertTrue(location.startswith('generated/blobs/'))
+            with open(location, 'r') as f:
+                self.assertEqual(json.load(f), {'a': 1})
+            self.assertEqual(
+                validation.generated_file_location('generated/1var_percent/sex.json'), 'generated/1var_percent/sex.json'
+            )
+
+    def test_perf_harness_find_slowdowns(self):
+        perf_harness = pgp.load_script('perf-harness.py')
+        baseline = {
+            'generate': {'wall_seconds': 2.0, 'cpu_seconds': 1.8, 'peak_rss_mb': 50},
+            'metadata': {'wall_seconds': 0.1, 'cpu_seconds': 0.1, 'peak_rss_mb': 20}
+        }
+        stages = {
+            'generate': {'wall_seconds': 2.4, 'cpu_seconds': 2.4, 'peak_rss_mb': 50},
+            'metadata': {'wall_seconds': 0.3, 'cpu_seconds': 0.3, 'peak_rss_mb': 20}
+        }
+        slowdowns = perf_harness.find_slowdowns(stages, baseline, 1.25, 0.5)
+        self.assertEqual(len(slowdowns), 1)
+        self.assertTrue(slowdowns[0].startswith('generate cpu_seconds'))
+        self.assertEqual(perf_harness.find_slowdowns(stages, baseline, 1.5, 0.5), [])
+
+    @unittest.skipUnless(os.environ.get('RUN_PERF_HARNESS'), 'set RUN_PERF_HARNESS=1 to run the whole perf harness')
+    def test_perf_harness_golden_outputs(self):
+        perf_harness = pgp.load_script('perf-harness.py')
+        with tempfile.TemporaryDirectory() as tmp:
+            result = perf_harness.run_harness(os.path.join(tmp, 'fixture'))
+        self.assertEqual(result['differences'], {'added': [], 'changed': [], 'removed': []})
+        self.assertEqual(list(result['stages']), [stage for stage, _ in perf_harness.STAGES])
+        for stage_result in result['stages'].values():
+            self.assertEqual(sorted(stage_result), ['cpu_seconds', 'peak_rss_mb', 'wall_seconds'])
+
 
 if __name__ == '__main__':
     unittest.main()
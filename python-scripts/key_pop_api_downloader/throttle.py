@@ -0,0 +1,254 @@
+"""Adaptive throttling of requests to the Census API."""
+
+import collections
+import email.utils
+import json
+import threading
+import time
+
+
+def get_header(headers, name):
+    """Return the value of HTTP header `name` from `headers`, ignoring case, or None if it is absent."""
+    if headers is None:
+        return None
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+
+def parse_retry_after(value, now=None):
+    """Return the number of seconds to wait given the value of a Retry-After header.
+
+    The value may be a number of seconds or an HTTP date. None is returned if the value
+    is missing or cannot be parsed.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_time - (time.time() if now is None else now))
+
+
+def parse_rate_limit_reset(value, now=None):
+    """Return the number of seconds to wait given the value of a RateLimit-Reset or X-RateLimit-Reset header.
+
+    The value may be a number of seconds, as for Retry-After, or (as many APIs send) the time of
+    the reset in seconds since the epoch. Values later than a day before `now` (by default the
+    current time) are taken to be times, so a clock that is slightly ahead of the server's
+    doesn't turn a reset time into a pause of decades.
+    """
+    pause = parse_retry_after(value, now)
+    if pause is None:
+        return None
+    now = time.time() if now is None else now
+    if pause > now - 24 * 60 * 60:
+        return max(0.0, pause - now)
+    return pause
+
+
+def percentile(values, p):
+    """Return the `p`th percentile of `values` (nearest-rank method), or None if `values` is empty."""
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * p // 100))
+    return ordered[int(rank) - 1]
+
+
+class AdaptiveThrottle:
+    """Limit the number of concurrent requests and the rate at which they start.
+
+    While the API responds quickly and without errors, the number of concurrent requests
+    is increased by one after each round of successful requests and the delay between
+    starting requests is reduced.  After a connection error, a 429 or a 5xx response,
+    the concurrency is halved and the delay doubled.  Retry-After and rate-limit headers
+    pause all requests for as long as the server asks.
+
+    Parameters
+    ----------
+    max_concurrency : int
+        The maximum number of requests in flight at once
+    initial_delay : float
+        The initial minimum number of seconds between starting requests
+    min_delay, max_delay : float
+        Bounds for the delay between starting requests
+    latency_target : float
+        Responses slower than this number of seconds are treated as a sign of pressure
+    window : int
+        The number of recent requests used for latency and error-rate metrics
+    report_every : int
+        Print metrics (and save them to `metrics_filename`) after this many requests
+    metrics_filename : str or None
+        A JSON file to which the latest metrics are written
+    """
+
+    def __init__(self, max_concurrency=4, initial_delay=0.5, min_delay=0.05, max_delay=120.0,
+                 latency_target=10.0, window=200, report_every=100, metrics_filename=None):
+        self.max_concurrency = max_concurrency
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.latency_target = latency_target
+        self.report_every = report_every
+        self.metrics_filename = metrics_filename
+
+        self.concurrency = 1
+        self.delay = initial_delay
+        self.in_flight = 0
+        self.next_start = 0.0
+        self.successes_since_increase = 0
+
+        self.start_time = time.monotonic()
+        self.request_count = 0
+        self.error_count = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.errors = collections.deque(maxlen=window)
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until a new request may start."""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.in_flight < self.concurrency and now >= self.next_start:
+                    self.in_flight += 1
+                    self.next_start = now + self.delay
+                    return
+                if self.in_flight < self.concurrency:
+                    self.condition.wait(self.next_start - now)
+                else:
+                    self.condition.wait()
+
+    def release(self, latency, status_code=None, headers=None):
+        """Record the outcome of a request started with `acquire`.
+
+        Parameters
+        ----------
+        latency : float
+            The time taken by the request in seconds
+        status_code : int or None
+            The HTTP status code, or None if there was a connection error
+        headers : dict or None
+            The response headers
+        """
+        with self.condition:
+            now = time.monotonic()
+            self.in_flight -= 1
+            self.request_count += 1
+            is_error = status_code is None or status_code == 429 or status_code >= 500
+            self.error_count += is_error
+            self.latencies.append(latency)
+            self.errors.append(is_error)
+
+            if is_error:
+                self.concurrency = max(1, self.concurrency // 2)
+                self.delay = min(self.max_delay, max(self.min_delay, self.delay * 2))
+                self.successes_since_increase = 0
+            elif latency > self.latency_target:
+                self.concurrency = max(1, self.concurrency - 1)
+                self.delay = min(self.max_delay, self.delay * 1.5)
+                self.successes_since_increase = 0
+            else:
+                self.successes_since_increase += 1
+                if self.successes_since_increase >= self.concurrency:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                    self.delay = max(self.min_delay, self.delay * 0.9)
+                    self.successes_since_increase = 0
+
+            pause = parse_retry_after(get_header(headers, 'Retry-After'))
+            remaining = get_header(headers, 'RateLimit-Remaining') or get_header(headers, 'X-RateLimit-Remaining')
+            if pause is None and remaining is not None and remaining.strip() == '0':
+                pause = parse_rate_limit_reset(
+                    get_header(headers, 'RateLimit-Reset') or get_header(headers, 'X-RateLimit-Reset')
+                )
+            if pause is not None:
+                self.next_start = max(self.next_start, now + min(pause, self.max_delay))
+
+            self.condition.notify_all()
+            report = self.request_count % self.report_every == 0
+
+        if report:
+            self.report()
+
+    def cancel(self):
+        """Give back a slot taken by `acquire` for a request whose outcome says nothing about
+        the API (for example one that failed because of a local bug), without recording it."""
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def fetch(self, url, get, max_attempts=10):
+        """Download `url`, retrying after connection errors, 429 and 5xx responses.
+
+        Parameters
+        ----------
+        url : str
+            The URL to download
+        get : function
+            A function such as `requests.get` that takes a URL and returns a response
+        max_attempts : int
+            The number of attempts before giving up
+
+        Returns
+        -------
+        bytes
+            The response body
+        """
+        for _ in range(max_attempts):
+            self.acquire()
+            start = time.monotonic()
+            try:
+                response = get(url)
+                content = response.content
+            except OSError:   # This includes requests.exceptions.ConnectionError
+                self.release(time.monotonic() - start)
+                print('Connection error')
+                continue
+            except BaseException:
+                # Any other exception is passed on, without counting it as an error from the API
+                self.cancel()
+                raise
+            self.release(time.monotonic() - start, response.status_code, response.headers)
+            if response.status_code == 429 or response.status_code >= 500:
+                print('HTTP status {}'.format(response.status_code))
+                continue
+            return content
+        raise IOError('Failed to download {} after {} attempts'.format(url, max_attempts))
+
+    def metrics(self):
+        """Return a dictionary of metrics about recent requests."""
+        with self.condition:
+            elapsed = time.monotonic() - self.start_time
+            return {
+                "requests": self.request_count,
+                "errors": self.error_count,
+                "requests_per_second": self.request_count / elapsed if elapsed > 0 else 0.0,
+                "latency_p50": percentile(self.latencies, 50),
+                "latency_p95": percentile(self.latencies, 95),
+                "error_rate": sum(self.errors) / len(self.errors) if len(self.errors) > 0 else 0.0,
+                "concurrency": self.concurrency,
+                "delay": self.delay
+            }
+
+    def report(self):
+        """Print the current metrics and save them to `metrics_filename`, if set."""
+        metrics = self.metrics()
+        print(
+            "{requests} requests, {requests_per_second:.2f}/s, p50 {p50}, p95 {p95}, "
+            "error rate {error_rate:.1%}, concurrency {concurrency}, delay {delay:.2f}s".format(
+                p50=format_seconds(metrics["latency_p50"]), p95=format_seconds(metrics["latency_p95"]), **metrics
+            )
+        )
+        if self.metrics_filename is not None:
+            with open(self.metrics_filename, 'w') as f:
+                json.dump(metrics, f, indent=4)
+
+
+def format_seconds(seconds):
+    return '-' if seconds is None else '{:.2f}s'.format(seconds)
@@ -0,0 +1,259 @@
+"""Checks of the downloaded and generated files, and a manifest of the files that failed them.
+
+The checks for each input classification combination are:
+
+- every downloaded file exists, can be read, and has a count for every cell unless it is blocked;
+- for each UR output classification c, the counts for `cc + [c]` summed over c match the counts
+  in the totals file for `cc`, and the LTLA-level counts summed over the LTLAs match them too,
+  to within a tolerance, since the API perturbs counts independently in each cube;
+- every generated file for the combination exists and has the expected categories.
+"""
+
+import itertools
+import json
+import os
+
+from . import dedup_blob_paths, generate_outfile_path, read_json_gz
+from . import metadata
+
+MANIFEST_FILENAME = 'downloaded/validation-manifest.json'
+DEDUP_MANIFEST_FILENAME = 'generated/dedup-manifest.json'
+DEFAULT_TOLERANCE = {"per_cell": 5, "relative": 0.001}
+
+
+def file_dimension_ids(path):
+    """Return the IDs of the classifications in a downloaded file, from its filename."""
+    name = os.path.basename(path)
+    name = name[:-len('.json.gz')]
+    if name.endswith('_by_geog'):
+        name = name[:-len('_by_geog')]
+    return name.split('-')
+
+
+def marginal_counts(data, dimension_ids):
+    """Sum the counts in an unblocked API response over all dimensions except `dimension_ids`.
+
+    Returns
+    -------
+    dict
+        A map from a tuple of option IDs (one for each of `dimension_ids`) to a
+        [count, number of cells summed] pair
+    """
+    result = {}
+    for obs in data['observations']:
+        options = {dim['dimension_id']: dim['option_id'] for dim in obs['dimensions']}
+        key = tuple(options[dimension_id] for dimension_id in dimension_ids)
+        if key not in result:
+            result[key] = [0, 0]
+        result[key][0] += obs['observation']
+        result[key][1] += 1
+    return result
+
+
+def compare_marginals(marginals, expected_marginals, tolerance):
+    """Return a description of the first difference between two results of `marginal_counts`, or None.
+
+    Counts may differ by `tolerance["per_cell"]` for each cell summed, plus a fraction
+    `tolerance["relative"]` of the larger count.
+    """
+    if set(marginals) != set(expected_marginals):
+        return 'categories {} do not match {}'.format(sorted(marginals), sorted(expected_marginals))
+    for key, (count, cells) in marginals.items():
+        expected_count, expected_cells = expected_marginals[key]
+        allowed = tolerance["per_cell"] * (cells + expected_cells) + tolerance["relative"] * max(count, expected_count)
+        if abs(count - expected_count) > allowed:
+            return 'count {} for {} differs from {} by more than {:.0f}'.format(count, key, expected_count, allowed)
+    return None
+
+
+def is_blocked(data):
+    return data.get('observations') is None or data['blocked_areas'] != 0
+
+
+def check_download(path, geography, problems):
+    """Read a downloaded file and check it on its own.
+
+    Problems are added to the dictionary `problems`, which maps paths to lists of descriptions.
+
+    Returns
+    -------
+    dict or None
+        The response, or None if it could not be read
+    """
+    try:
+        data = read_json_gz(path)
+    except Exception as e:  # a damaged gzip or compact file can raise many kinds of error
+        problems.setdefault(path, []).append('unreadable: {}'.format(e))
+        return None
+    if not isinstance(data, dict) or 'blocked_areas' not in data or 'observations' not in data:
+        problems.setdefault(path, []).append('not a census-observations response')
+        return None
+    if data['observations'] is None:
+        if geography == 'nat' and data['blocked_areas'] == 0:
+            problems.setdefault(path, []).append('observations are null but no areas are blocked')
+        return data
+    all_classifications = metadata.all_classifications()
+    expected_cells = 1
+    for c in file_dimension_ids(path):
+        expected_cells *= len(all_classifications[c]["categories"])
+    if geography == 'ltla':
+        expected_cells *= len(metadata.ltlas()) - data['blocked_areas']
+    if len(data['observations']) != expected_cells and (geography == 'nat' or data['blocked_areas'] == 0):
+        problems.setdefault(path, []).append(
+            'expected {} observations, found {}'.format(expected_cells, len(data['observations']))
+        )
+    if any(obs['observation'] < 0 for obs in data['observations']):
+        problems.setdefault(path, []).append('negative count')
+    return data
+
+
+def check_downloads(combination, tolerance, problems):
+    """Check the downloaded files for an input classification combination.
+
+    Returns
+    -------
+    list
+        The paths that were checked
+    """
+    cc = combination["cc"]
+    checked = []
+    total_data = None
+    if combination["total_path"] is not None:
+        checked.append(combination["total_path"])
+        total_data = check_download(combination["total_path"], 'nat', problems)
+    if combination["ltla_path"] is not None:
+        checked.append(combination["ltla_path"])
+        ltla_data = check_download(combination["ltla_path"], 'ltla', problems)
+        if ltla_data is not None and total_data is not None and not is_blocked(ltla_data) \
+                and not is_blocked(total_data):
+            difference = compare_marginals(
+                marginal_counts(ltla_data, cc), marginal_counts(total_data, cc), tolerance
+            )
+            if difference is not None:
+                problems.setdefault(combination["ltla_path"], []).append(
+                    'LTLA sums do not match {}: {}'.format(combination["total_path"], difference)
+                )
+    for output in combination["outputs"]:
+        if not output["download"]:
+            # The file is downloaded for a smaller combination, and checked with it
+            continue
+        checked.append(output["path"])
+        output_data = check_download(output["path"], 'nat', problems)
+        if output_data is None or total_data is None or output["poptype"] != 'UR' \
+                or is_blocked(output_data) or is_blocked(total_data):
+            continue
+        dimension_ids = [c for c in file_dimension_ids(output["path"]) if c != output["c"]]
+        difference = compare_marginals(
+            marginal_counts(output_data, dimension_ids), marginal_counts(total_data, dimension_ids), tolerance
+        )
+        if difference is not None:
+            problems.setdefault(output["path"], []).append(
+                'sums over {} do not match {}: {}'.format(output["c"], combination["total_path"], difference)
+            )
+    return checked
+
+
+def generated_paths(cc):
+    """Return the paths of the national, LTLA-level and combined generated files for `cc`,
+    with the category IDs that each national and LTLA-level file should contain."""
+    if len(cc) == 0:
+        return [('generated/0var_percent/data.json', None)]
+    all_classifications = metadata.all_classifications()
+    last_category_ids = sorted(cat['id'] for cat in all_classifications[cc[-1]]["categories"])
+    paths = []
+    for category_list in itertools.product(*(all_classifications[c]["categories"] for c in cc[:-1])):
+        for pattern, suffix, category_ids in [
+            ('generated/{}var_percent/{}', '.json', last_category_ids),
+            ('generated/{}var-by-ltla_percent/{}', '_by_geog.json', last_category_ids),
+            ('generated/{}var-combined_percent/{}', '.json', None)
+        ]:
+            path = generate_outfile_path(cc, category_list, pattern, suffix, create_directory=False)
+            paths.append((os.path.normpath(path), category_ids))
+    return paths
+
+
+_dedup_blob_paths = None
+
+
+def generated_file_location(path):
+    """Return the file to read for the generated file `path`: the path itself or, if it
+    has been deduplicated with --dedup=manifest (see `new_dedup_store`), its blob."""
+    global _dedup_blob_paths
+    if os.path.isfile(path):
+        return path
+    if _dedup_blob_paths is None:
+        _dedup_blob_paths = dedup_blob_paths(DEDUP_MANIFEST_FILENAME)
+    return _dedup_blob_paths.get(path, path)
+
+
+def check_generated(combination, problems):
+    """Check that the generated files for a combination exist and have the expected categories.
+
+    Returns
+    -------
+    list
+        The paths that were checked
+    """
+    checked = []
+    for path, category_ids in generated_paths(combination["cc"]):
+        checked.append(path)
+        try:
+            with open(generated_file_location(path), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            problems.setdefault(path, []).append('unreadable: {}'.format(e))
+            continue
+        if category_ids is not None and sorted(data) != category_ids:
+            problems.setdefault(path, []).append('categories {} are not {}'.format(sorted(data), category_ids))
+        if category_ids is None and '-combined_percent/' in path and sorted(data) != ['bar_chart_data', 'map_data']:
+            problems.setdefault(path, []).append('not a combined file')
+    return checked
+
+
+def validate_combination(task):
+    """Run the checks for one combination.
+
+    Parameters
+    ----------
+    task : tuple
+        (num_vars, index of the combination in `metadata.combinations(num_vars)`, tolerance,
+        whether to check downloaded files, whether to check generated files)
+
+    Returns
+    -------
+    list, dict
+        The paths checked, and a map from path to a list of problems
+    """
+    num_vars, i, tolerance, downloaded, generated = task
+    combination = metadata.combinations(num_vars)[i]
+    problems = {}
+    checked = []
+    if downloaded:
+        checked += check_downloads(combination, tolerance, problems)
+    if generated:
+        checked += check_generated(combination, problems)
+    return checked, problems
+
+
+def load_manifest(filename=MANIFEST_FILENAME):
+    if not os.path.isfile(filename):
+        return {"files": {}}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def update_manifest(manifest, checked, problems):
+    """Replace the results for the paths in `checked` with `problems`."""
+    for path in checked:
+        manifest["files"].pop(path, None)
+    manifest["files"].update(problems)
+
+
+def save_manifest(manifest, filename=MANIFEST_FILENAME):
+    with open(filename, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+
+
+def invalid_files(filename=MANIFEST_FILENAME):
+    """Return the set of paths that failed validation, according to the manifest `filename`."""
+    return set(load_manifest(filename)["files"])
@@ -0,0 +1,209 @@
+"""Run the generate and combine stages on a fixed synthetic fixture, check every generated file
+against the golden hashes, and record the wall-clock time, CPU time and peak memory of each stage.
+
+The fixture (see key_pop_api_downloader/test/fixture.py) is built in a temporary directory,
+and each stage is run as a separate process. The results are saved as JSON. If a baseline
+results file is given, the harness fails if any stage is more than --max-slowdown times slower
+than in the baseline. It also fails if any generated file differs from the golden hashes.
+Run with --update-golden after a change that is meant to alter the generated files.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import key_pop_api_downloader as pgp
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_HASHES_FILENAME = os.path.join(SCRIPTS_DIR, 'key_pop_api_downloader/test/golden-hashes.json')
+STAGES = [
+    ('combine-dims', 'combine-all-dims.py'),
+    ('generate', 'generate-files.py'),
+    ('generate-ltla', 'generate-files-by-ltla.py'),
+    ('combine', 'combine-jsons-for-bars-and-maps.py'),
+    ('metadata', 'create-metadata-json.py')
+]
+# Stages whose scripts accept --sparse
+SPARSE_STAGES = ['generate', 'generate-ltla']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', default='perf-results.json', help='the results file (default: perf-results.json)')
+    parser.add_argument('--baseline', help='a results file from an earlier run to compare timings with')
+    parser.add_argument('--max-slowdown', type=float, default=1.25,
+                        help='the largest allowed ratio of wall-clock or CPU time to the baseline (default: 1.25)')
+    parser.add_argument('--min-seconds', type=float, default=0.5,
+                        help="don't compare the timings of stages that took less than this in the baseline, "
+                             "since they are dominated by noise (default: 0.5)")
+    parser.add_argument('--work-dir', help='build the fixture here (which must not exist) and keep it, '
+                                           'rather than in a temporary directory')
+    parser.add_argument('--sparse', action='store_true', help='pass --sparse to the generate stages')
+    parser.add_argument('--update-golden', action='store_true', help='save the hashes of the generated files')
+    return parser.parse_args()
+
+
+def run_stage(script, args, cwd):
+    """Run a script in a new process, and measure the resources that it uses.
+
+    Returns
+    -------
+    dict
+        The exit code, wall-clock time, CPU time (user plus system) and peak resident set size.
+        The CPU time includes any child processes that the script waits for, such as worker pools.
+    """
+    with tempfile.TemporaryFile() as stderr_file:
+        start = time.perf_counter()
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(SCRIPTS_DIR, script)] + args,
+            cwd=cwd, stdout=subprocess.DEVNULL, stderr=stderr_file
+        )
+        # os.wait4 (unlike Popen.wait) gives the resource usage of the process
+        _, status, rusage = os.wait4(process.pid, 0)
+        wall_seconds = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+        stderr_file.seek(0)
+        stderr = stderr_file.read().decode('utf-8', 'replace')
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    peak_rss_bytes = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    return {
+        "returncode": process.returncode,
+        "stderr": stderr,
+        "wall_seconds": round(wall_seconds, 3),
+        "cpu_seconds": round(rusage.ru_utime + rusage.ru_stime, 3),
+        "peak_rss_mb": round(peak_rss_bytes / 1024 / 1024, 1)
+    }
+
+
+def run_stages(work_dir, sparse=False):
+    """Build the fixture in `work_dir` and run every stage on it.
+
+    Returns
+    -------
+    dict
+        A map from stage name to the result of `run_stage`
+
+    Raises
+    ------
+    RuntimeError
+        If a stage fails
+    """
+    # The fixture is built in a separate process, since a child process's peak RSS includes
+    # that of its parent when it was started
+    subprocess.run(
+        [sys.executable, '-m', 'key_pop_api_downloader.test.fixture', os.path.abspath(work_dir)],
+        cwd=SCRIPTS_DIR, check=True
+    )
+    results = {}
+    for stage, script in STAGES:
+        args = ['--sparse'] if sparse and stage in SPARSE_STAGES else []
+        result = run_stage(script, args, work_dir)
+        if result["returncode"] != 0:
+            raise RuntimeError('Stage {} failed:\n{}'.format(stage, result["stderr"]))
+        del result["returncode"], result["stderr"]
+        results[stage] = result
+    return results
+
+
+def load_golden_hashes(filename=GOLDEN_HASHES_FILENAME):
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save_golden_hashes(hashes, filename=GOLDEN_HASHES_FILENAME):
+    with open(filename, 'w') as f:
+        json.dump(hashes, f, indent=4, sort_keys=True)
+        f.write('\n')
+
+
+def find_slowdowns(stages, baseline_stages, max_slowdown, min_seconds):
+    """Return a description of each timing in `stages` that is more than `max_slowdown` times
+    the corresponding timing in `baseline_stages`, ignoring timings below `min_seconds` in the baseline."""
+    slowdowns = []
+    for stage, result in stages.items():
+        if stage not in baseline_stages:
+            continue
+        for key in ['wall_seconds', 'cpu_seconds']:
+            baseline_seconds = baseline_stages[stage][key]
+            if baseline_seconds >= min_seconds and result[key] > max_slowdown * baseline_seconds:
+                slowdowns.append('{} {}: {:.2f}s, baseline {:.2f}s ({:.2f}x)'.format(
+                    stage, key, result[key], baseline_seconds, result[key] / baseline_seconds
+                ))
+    return slowdowns
+
+
+def print_stages(stages):
+    print('{:15} {:>10} {:>10} {:>14}'.format('stage', 'wall', 'cpu', 'peak RSS (MB)'))
+    for stage, result in stages.items():
+        print('{:15} {:>9.2f}s {:>9.2f}s {:>14.1f}'.format(
+            stage, result["wall_seconds"], result["cpu_seconds"], result["peak_rss_mb"]
+        ))
+
+
+def run_harness(work_dir, sparse=False):
+    """Run the stages in `work_dir` and compare the generated files with the golden hashes.
+
+    Returns
+    -------
+    dict
+        'stages' (see `run_stages`), 'hashes' (a manifest of the generated files from
+        `pgp.build_file_manifest`) and 'differences' (from `pgp.diff_file_manifests`)
+    """
+    stages = run_stages(work_dir, sparse)
+    hashes = pgp.build_file_manifest(os.path.join(work_dir, 'generated'), processes=1)
+    return {
+        "stages": stages,
+        "hashes": hashes,
+        "differences": pgp.diff_file_manifests(load_golden_hashes(), hashes)
+    }
+
+
+def main():
+    args = parse_args()
+    if args.work_dir is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            result = run_harness(os.path.join(tmp, 'fixture'), args.sparse)
+    else:
+        result = run_harness(args.work_dir, args.sparse)
+    print_stages(result["stages"])
+
+    failed = False
+    if args.update_golden:
+        save_golden_hashes(result["hashes"])
+        print('Saved the hashes of {} files to {}'.format(len(result["hashes"]), GOLDEN_HASHES_FILENAME))
+    else:
+        for kind, paths in result["differences"].items():
+            for path in paths:
+                print('{}: {}'.format(kind, path))
+                failed = True
+        if not failed:
+            print('All {} generated files match the golden hashes'.format(len(result["hashes"])))
+
+    with open(args.output, 'w') as f:
+        json.dump({
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "sparse": args.sparse,
+            "stages": result["stages"],
+            "differences": result["differences"]
+        }, f, indent=4)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        slowdowns = find_slowdowns(result["stages"], baseline["stages"], args.max_slowdown, args.min_seconds)
+        for slowdown in slowdowns:
+            print('Slower than the baseline: ' + slowdown)
+        failed = failed or len(slowdowns) > 0
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Compare the generated files with the previous release and list (or package) the files that changed.
+
+Files that only exist as blobs (written with --dedup=manifest) are published from their blobs,
+under the paths recorded in the dedup manifest.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tarfile
+
+import key_pop_api_downloader as pgp
+
+# The blobs and manifest written by --dedup (see pgp.new_dedup_store) aren't published themselves
+EXCLUDED_PATHS = ['blobs', 'dedup-manifest.json']
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--root', default='generated',
+                        help='the directory of generated files (default: generated)')
+    parser.add_argument('--previous-manifest',
+                        help="the previous release's manifest; if omitted, every file is treated as added")
+    parser.add_argument('--manifest-out', default='release-manifest.json',
+                        help='where to save the manifest for this release (default: release-manifest.json)')
+    parser.add_argument('--changes-out', default='release-changes.json',
+                        help='where to save the lists of added, changed and removed files '
+                             '(default: release-changes.json)')
+    parser.add_argument('--tarball',
+                        help='if given, write the added and changed files to this .tar.gz file')
+    parser.add_argument('--processes', type=int,
+                        help='the number of hashing processes (default: one per CPU)')
+    return parser.parse_args()
+
+
+def blob_only_files(root):
+    """Return a map from the path (relative to `root`) of each file in the dedup manifest of `root`
+    that doesn't exist as a file to the path of its blob.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the blob of such a file is missing
+    """
+    result = {}
+    for path, blob_path in pgp.dedup_blob_paths(os.path.join(root, 'dedup-manifest.json')).items():
+        if os.path.isfile(path):
+            continue
+        if not os.path.isfile(blob_path):
+            raise FileNotFoundError('{} is in the dedup manifest, but neither it nor its blob {} exists'.format(
+                path, blob_path
+            ))
+        result[os.path.relpath(path, root).replace(os.sep, '/')] = blob_path
+    return result
+
+
+def main():
+    args = parse_args()
+
+    old_manifest = {}
+    if args.previous_manifest is not None:
+        with open(args.previous_manifest, 'r') as f:
+            old_manifest = json.load(f)["files"]
+
+    try:
+        blob_paths = blob_only_files(args.root)
+    except FileNotFoundError as e:
+        print(e)
+        sys.exit(1)
+    new_manifest = pgp.build_file_manifest(args.root, args.processes, EXCLUDED_PATHS)
+    # A blob is named by the SHA-256 hash of its contents
+    new_manifest.update({
+        path: os.path.basename(blob_path)[:-len('.json')] for path, blob_path in blob_paths.items()
+    })
+    changes = pgp.diff_file_manifests(old_manifest, new_manifest)
+
+    with open(args.manifest_out, 'w') as f:
+        json.dump({"root": args.root, "files": new_manifest}, f)
+    with open(args.changes_out, 'w') as f:
+        json.dump(changes, f, indent=4)
+
+    if args.tarball is not None:
+        with tarfile.open(args.tarball, 'w:gz') as tar:
+            for path in changes["added"] + changes["changed"]:
+                tar.add(blob_paths.get(path, os.path.join(args.root, path)), arcname=path)
+
+    print("{} files: {} added, {} changed, {} removed".format(
+        len(new_manifest), len(changes["added"]), len(changes["changed"]), len(changes["removed"])
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""Run the whole pipeline (download, generate, combine, validate) in a single process.
+
+Downloading and generation are pipelined: the files for an input classification
+combination are generated as soon as the files that they need have been downloaded,
+and the downloaded responses are passed to the generation step in memory. The bar chart
+and map files for each combination are then combined straight away. The exit status
+is 1 if the validate stage finds any problems.
+"""
+
+import argparse
+import concurrent.futures
+import json
+import os
+import runpy
+import sys
+import threading
+import time
+
+import key_pop_api_downloader as pgp
+from key_pop_api_downloader import metadata
+
+STAGES = [
+    'setup', 'ltla-geog', 'dims', 'combine-dims', 'download', 'download-ltla',
+    'generate', 'generate-ltla', 'combine', 'metadata', 'validate'
+]
+API_URL = 'https://api.beta.ons.gov.uk/v1'
+
+
+class DownloadCache:
+    """Downloaded responses, kept in memory until every generation task that reads them has done so.
+
+    Parameters
+    ----------
+    read_counts : dict
+        A map from downloaded file path to the number of times that it will be read
+    max_bytes : int
+        Responses are only kept while their total size is at most this; other files are read from disk
+    """
+
+    def __init__(self, read_counts, max_bytes):
+        self.read_counts = read_counts
+        self.max_bytes = max_bytes
+        self.responses = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def put(self, path, response_bytes):
+        with self.lock:
+            if self.read_counts.get(path, 0) > 0 and self.total_bytes + len(response_bytes) <= self.max_bytes:
+                self.total_bytes += len(response_bytes) - len(self.responses.get(path, b''))
+                self.responses[path] = response_bytes
+
+    def read(self, path):
+        with self.lock:
+            response_bytes = self.responses.get(path)
+            self.read_counts[path] = self.read_counts.get(path, 1) - 1
+            if self.read_counts[path] <= 0 and path in self.responses:
+                del self.responses[path]
+                self.total_bytes -= len(response_bytes)
+        if response_bytes is None:
+            return pgp.read_json_gz(path)
+        return json.loads(response_bytes.decode('utf-8'))
+
+
+def new_timings():
+    return {
+        "lock": threading.Lock(),
+        "stages": {stage: {"start": None, "end": None, "busy": 0.0, "tasks": 0} for stage in STAGES}
+    }
+
+
+def timed(timings, stage, fn, *args):
+    """Call `fn(*args)`, adding the time taken to the timings for `stage`."""
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        end = time.perf_counter()
+        with timings["lock"]:
+            stage_timings = timings["stages"][stage]
+            if stage_timings["start"] is None or start < stage_timings["start"]:
+                stage_timings["start"] = start
+            if stage_timings["end"] is None or end > stage_timings["end"]:
+                stage_timings["end"] = end
+            stage_timings["busy"] += end - start
+            stage_timings["tasks"] += 1
+
+
+def after(futures, fn, *args):
+    """Wait for `futures` to finish (raising any exception that they raised), then call `fn(*args)`."""
+    for future in futures:
+        future.result()
+    return fn(*args)
+
+
+def print_timings(timings):
+    print()
+    print('{:15} {:>10} {:>10} {:>8}'.format('stage', 'wall', 'busy', 'tasks'))
+    for stage in STAGES:
+        stage_timings = timings["stages"][stage]
+        if stage_timings["tasks"] == 0:
+            continue
+        print('{:15} {:>9.1f}s {:>9.1f}s {:>8}'.format(
+            stage, stage_timings["end"] - stage_timings["start"], stage_timings["busy"], stage_timings["tasks"]
+        ))
+
+
+def run_script(filename):
+    """Run one of the scripts in the python-scripts directory in this process."""
+    runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename), run_name='__main__')
+
+
+def setup(max_var_selections):
+    for d in ['downloaded', 'generated']:
+        for num_vars in range(max_var_selections + 1):
+            os.makedirs('{}/{}var'.format(d, num_vars), exist_ok=True)
+            os.makedirs('{}/{}var-by-ltla'.format(d, num_vars), exist_ok=True)
+
+
+def get_json_file(url, filename, get_data, config):
+    """Download a JSON file from the API, unless it exists and --skip-existing was given."""
+    if config["skip_existing_files"] and os.path.isfile(filename):
+        print("Skipping existing file {}".format(filename))
+        return
+    print(url)
+    with open(filename, 'wb') as f:
+        f.write(get_data.download(url, config))
+
+
+def get_ltla_geog(get_data, config):
+    """Download a list of LTLAs."""
+    get_json_file(API_URL + '/population-types/UR/area-types/ltla/areas?limit=1000',
+                  'downloaded/ltla-geog.json', get_data, config)
+
+
+def get_dims(get_data, config):
+    """Download lists of dimensions and classifications for usual residents."""
+    get_json_file(API_URL + '/population-types?limit=100', 'downloaded/poptypes.json', get_data, config)
+    for poptype in ['UR', 'UR_HH']:
+        dimensions_filename = 'downloaded/dimensions-{}.json'.format(poptype)
+        get_json_file(API_URL + '/population-types/{}/dimensions?limit=200'.format(poptype),
+                      dimensions_filename, get_data, config)
+        os.makedirs('downloaded/classifications-{}'.format(poptype), exist_ok=True)
+        with open(dimensions_filename, 'r') as f:
+            dimensions = json.load(f)["items"]
+        for dim in dimensions:
+            get_json_file(
+                API_URL + '/population-types/{}/dimensions/{}/categorisations'.format(poptype, dim["id"]),
+                'downloaded/classifications-{}/{}.json'.format(poptype, dim["id"]), get_data, config
+            )
+
+
+def national_paths(combination, downloaded_here_only=False):
+    """Return the national-level downloaded files used (or, optionally, only those downloaded) for a combination."""
+    paths = [] if combination["total_path"] is None else [combination["total_path"]]
+    return paths + [
+        output["path"] for output in combination["outputs"] if output["download"] or not downloaded_here_only
+    ]
+
+
+def run_data_stages(selected_stages, args, timings, dedup_store, generate_dedup_store):
+    """Run the download and generate stages in `selected_stages`, pipelined so that the
+    files for each combination are generated as soon as their downloads are complete.
+
+    The generated files are written with `generate_dedup_store` and the combined files with `dedup_store`.
+    """
+    max_var_selections = pgp.get_config("input-txt-files/config.json", "max_var_selections")
+
+    if 'generate-ltla' in selected_stages:
+        generate_files_by_ltla = pgp.load_script('generate-files-by-ltla.py')
+        memory_ceiling_mb = pgp.get_config("input-txt-files/config.json", "ltla_memory_ceiling_mb", 2048)
+        memory_report = []
+        map_data_format = generate_files_by_ltla.get_map_data_format()
+
+    read_counts = {}
+    for num_vars in range(max_var_selections + 1):
+        for combination in metadata.combinations(num_vars):
+            if 'generate' in selected_stages:
+                for path in national_paths(combination):
+                    read_counts[path] = read_counts.get(path, 0) + 1
+            if 'generate-ltla' in selected_stages and num_vars > 0:
+                # Combinations over the memory ceiling are streamed from disk, so their responses aren't cached
+                estimated_bytes = generate_files_by_ltla.estimate_lookup_bytes(combination["cc"])
+                if estimated_bytes <= memory_ceiling_mb * 1024 * 1024:
+                    read_counts[combination["ltla_path"]] = read_counts.get(combination["ltla_path"], 0) + 1
+    download_cache = DownloadCache(read_counts, args.memory_cache_mb * 1024 * 1024)
+
+    max_concurrency = 1
+    if 'download' in selected_stages or 'download-ltla' in selected_stages:
+        get_data = pgp.load_script('get-data.py')
+        get_data_by_ltla = pgp.load_script('get-data-by-ltla.py')
+        national_config = get_data.make_config(sys.argv)
+        national_config["download_cache"] = download_cache
+        ltla_config = get_data_by_ltla.make_config(sys.argv)
+        ltla_config["download_cache"] = download_cache
+        # Both kinds of download share one throttle
+        ltla_config["throttle"] = national_config["throttle"]
+        max_concurrency = national_config["throttle"].max_concurrency
+    if 'generate' in selected_stages:
+        generate_files = pgp.load_script('generate-files.py')
+    # If both kinds of file are generated here, each combination's files are combined as soon as they exist
+    combine_here = {'generate', 'generate-ltla', 'combine'} <= selected_stages
+    if combine_here:
+        combine_jsons = pgp.load_script('combine-jsons-for-bars-and-maps.py')
+
+    unblocked_combination_counts = {}
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_concurrency) as download_executor, \
+            concurrent.futures.ThreadPoolExecutor(1) as generate_executor:
+        # A map from downloaded file path to the future for the task that downloads it
+        producers = {}
+        for num_vars in range(max_var_selections + 1):
+            for i, combination in enumerate(metadata.combinations(num_vars)):
+                if 'download' in selected_stages:
+                    future = download_executor.submit(
+                        timed, timings, 'download', get_data.get_combination_files, combination, national_config
+                    )
+                    futures.append(future)
+                    for path in national_paths(combination, downloaded_here_only=True):
+                        producers[path] = future
+                if 'download-ltla' in selected_stages and num_vars > 0:
+                    future = download_executor.submit(
+                        timed, timings, 'download-ltla', get_data_by_ltla.get_file, num_vars, i, combination,
+                        ltla_config
+                    )
+                    futures.append(future)
+                    producers[combination["ltla_path"]] = future
+                generate_futures = []
+                if 'generate' in selected_stages:
+                    generate_futures.append(generate_executor.submit(
+                        after, {producers[path] for path in national_paths(combination) if path in producers},
+                        timed, timings, 'generate', generate_files.generate_combination_files,
+                        num_vars, i, combination, unblocked_combination_counts, generate_dedup_store,
+                        download_cache.read, args.sparse
+                    ))
+                if 'generate-ltla' in selected_stages and num_vars > 0:
+                    generate_futures.append(generate_executor.submit(
+                        after, [producers[combination["ltla_path"]]] if combination["ltla_path"] in producers else [],
+                        timed, timings, 'generate-ltla', generate_files_by_ltla.generate_combination_files,
+                        num_vars, i, combination, generate_dedup_store, download_cache.read, memory_ceiling_mb,
+                        memory_report, args.sparse, map_data_format
+                    ))
+                futures += generate_futures
+                if combine_here and num_vars > 0:
+                    futures.append(generate_executor.submit(
+                        after, generate_futures, timed, timings, 'combine', combine_jsons.combine_pairs,
+                        combine_jsons.combination_pairs(combination["cc"]), dedup_store, 1, True
+                    ))
+        for future in futures:
+            future.result()
+
+    if 'download' in selected_stages or 'download-ltla' in selected_stages:
+        national_config["throttle"].report()
+    if 'generate' in selected_stages:
+        generate_files.save_unblocked_combination_counts(unblocked_combination_counts)
+    if 'generate-ltla' in selected_stages:
+        generate_files_by_ltla.save_memory_report(memory_report)
+    return combine_here
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--stages', help='a comma-separated list of stages to run (default: all). '
+                                         'Stages: ' + ', '.join(STAGES))
+    parser.add_argument('--from-stage', choices=STAGES, help='run this stage and all later stages')
+    parser.add_argument('--memory-cache-mb', type=int, default=1024,
+                        help='the maximum size of downloaded responses kept in memory (default: 1024)')
+    # The following options are passed on to the individual stages
+    parser.add_argument('--skip-existing', action='store_true', help="don't download files that already exist")
+    parser.add_argument('--bulk', action='store_true',
+                        help='use the bulk download strategy, whose files are sums of larger, independently '
+                             'perturbed cubes and so differ slightly from per-output downloads')
+    parser.add_argument('--compact', action='store_true', help='save downloads in the compact format')
+    parser.add_argument('--keep-json', action='store_true', help='with --compact, also save the JSON')
+    parser.add_argument('--dedup', choices=['hardlink', 'manifest'], help='deduplicate generated files')
+    parser.add_argument('--sparse', action='store_true', help='leave zero cells out of the lookups')
+    parser.add_argument('--validate-full', action='store_true',
+                        help='validate every combination, rather than a sample of 100 at each level')
+    args = parser.parse_args()
+    if args.stages is not None and args.from_stage is not None:
+        parser.error('--stages and --from-stage cannot be used together')
+    if args.stages is not None:
+        for stage in args.stages.split(','):
+            if stage not in STAGES:
+                parser.error('unknown stage: ' + stage)
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.stages is not None:
+        selected_stages = set(args.stages.split(','))
+    elif args.from_stage is not None:
+        selected_stages = set(STAGES[STAGES.index(args.from_stage):])
+    else:
+        selected_stages = set(STAGES)
+
+    timings = new_timings()
+    dedup_store = pgp.new_dedup_store(args.dedup) if args.dedup else None
+    # Manifest mode only writes blobs, but the combine stage reads the generated files,
+    # so those are hard-linked to their blobs; only the combined files are left as blobs
+    generate_dedup_store = dedup_store
+    if dedup_store is not None and dedup_store["mode"] == 'manifest':
+        generate_dedup_store = pgp.new_dedup_store('hardlink', dedup_store["blob_directory"])
+    max_var_selections = pgp.get_config("input-txt-files/config.json", "max_var_selections")
+
+    if 'setup' in selected_stages:
+        timed(timings, 'setup', setup, max_var_selections)
+    if 'ltla-geog' in selected_stages or 'dims' in selected_stages:
+        get_data = pgp.load_script('get-data.py')
+        config = get_data.make_config(sys.argv)
+        if 'ltla-geog' in selected_stages:
+            timed(timings, 'ltla-geog', get_ltla_geog, get_data, config)
+        if 'dims' in selected_stages:
+            timed(timings, 'dims', get_dims, get_data, config)
+    if 'combine-dims' in selected_stages:
+        timed(timings, 'combine-dims', pgp.load_script('combine-all-dims.py').main)
+    # The earlier stages may have changed the files that the metadata is loaded from
+    metadata.reset()
+
+    combined = False
+    if selected_stages & {'download', 'download-ltla', 'generate', 'generate-ltla'}:
+        combined = run_data_stages(selected_stages, args, timings, dedup_store, generate_dedup_store)
+    if 'combine' in selected_stages and not combined:
+        timed(timings, 'combine', pgp.load_script('combine-jsons-for-bars-and-maps.py').combine_files, dedup_store)
+    if dedup_store is not None and selected_stages & {'generate', 'generate-ltla', 'combine'}:
+        if generate_dedup_store is not dedup_store:
+            pgp.merge_dedup_stores(dedup_store, generate_dedup_store)
+        removed_blob_count = pgp.save_dedup_manifest(dedup_store)
+        pgp.print_dedup_report(dedup_store, removed_blob_count)
+
+    if 'metadata' in selected_stages:
+        timed(timings, 'metadata', run_script, 'create-metadata-json.py')
+    problems = {}
+    if 'validate' in selected_stages:
+        validate = pgp.load_script('validate.py')
+        tasks = validate.make_tasks(None if args.validate_full else 100)
+        checked_count, problems = timed(timings, 'validate', validate.validate, tasks)
+        validate.print_report(checked_count, problems)
+
+    print_timings(timings)
+    if problems:
+        sys.exit(1)
+    print("All done!")
+
+
+if __name__ == "__main__":
+    main()
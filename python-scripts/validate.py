@@ -0,0 +1,94 @@
+"""Check the downloaded and generated files for consistency, in parallel.
+
+By default, a random sample of input classification combinations at each level is checked;
+with --full, every combination is checked. Files that fail the checks are recorded in
+downloaded/validation-manifest.json, so that the download scripts fetch them again even with
+--skip-existing, and combine-jsons-for-bars-and-maps.py rewrites them. Files that pass are
+removed from the manifest. The exit status is 1 if any problems were found.
+"""
+
+import argparse
+import multiprocessing
+import random
+import sys
+
+import key_pop_api_downloader as pgp
+from key_pop_api_downloader import metadata
+from key_pop_api_downloader import validation
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--full', action='store_true', help='check every combination')
+    parser.add_argument('--sample', type=int, default=100,
+                        help='the number of combinations to check at each level, without --full (default: 100)')
+    parser.add_argument('--seed', type=int, help='the random seed for sampling combinations')
+    parser.add_argument('--processes', type=int, help='the number of worker processes (default: one per CPU)')
+    parser.add_argument('--skip-downloaded', action='store_true', help="don't check the downloaded files")
+    parser.add_argument('--skip-generated', action='store_true', help="don't check the generated files")
+    return parser.parse_args()
+
+
+def make_tasks(sample=None, seed=None, downloaded=True, generated=True):
+    """Return the tasks for `validation.validate_combination`.
+
+    Parameters
+    ----------
+    sample : int or None
+        The number of combinations to check at each level, or None to check them all
+    seed : int or None
+        The random seed for sampling
+    downloaded, generated : bool
+        Whether to check the downloaded and generated files
+    """
+    max_var_selections = pgp.get_config('input-txt-files/config.json', 'max_var_selections')
+    tolerance = pgp.get_config('input-txt-files/config.json', 'validation_tolerance', validation.DEFAULT_TOLERANCE)
+    rng = random.Random(seed)
+    tasks = []
+    for num_vars in range(max_var_selections + 1):
+        indices = range(len(metadata.combinations(num_vars)))
+        if sample is not None and sample < len(indices):
+            indices = sorted(rng.sample(indices, sample))
+        tasks += [(num_vars, i, tolerance, downloaded, generated) for i in indices]
+    return tasks
+
+
+def validate(tasks, processes=None):
+    """Run `tasks` and update the validation manifest.
+
+    Returns
+    -------
+    int, dict
+        The number of files checked, and a map from each path that failed to a list of problems
+    """
+    manifest = validation.load_manifest()
+    checked_count = 0
+    all_problems = {}
+    with multiprocessing.Pool(processes) as pool:
+        for checked, problems in pool.imap_unordered(validation.validate_combination, tasks, chunksize=16):
+            validation.update_manifest(manifest, checked, problems)
+            checked_count += len(checked)
+            all_problems.update(problems)
+    validation.save_manifest(manifest)
+    return checked_count, all_problems
+
+
+def print_report(checked_count, problems):
+    for path in sorted(problems):
+        for problem in problems[path]:
+            print('{}: {}'.format(path, problem))
+    print('Checked {} files; {} had problems'.format(checked_count, len(problems)))
+
+
+def main():
+    args = parse_args()
+    tasks = make_tasks(None if args.full else args.sample, args.seed,
+                       not args.skip_downloaded, not args.skip_generated)
+    checked_count, problems = validate(tasks, args.processes)
+    print_report(checked_count, problems)
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()